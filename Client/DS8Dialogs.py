@@ -40,6 +40,8 @@ from logging import info
 
 from configparser import Error
 
+from json import dumps
+
 # Our own modules.
 
 import config
@@ -276,12 +278,34 @@ class DS8Dialog(QDialog, Ui_DSuper8):
         self.oldStopsBox = 0.0
         self.oldShowHist = True
 
+        # Commands collected for a settings snapshot. None -> the commands
+        # are sent immediately.
+        self.snapshot = None
+
     # This function is used to send control sequences to the server.
+    # While a settings snapshot is open, the commands are collected.
     def sendCtrl(self, cmd):
+        if self.snapshot is not None:
+            self.snapshot.append(cmd)
+            return
+
         info("CTRL: " + cmd)
         config.ctrlConn.write(cmd + "\n")
         config.ctrlConn.flush()
 
+    # Settings snapshot. The commands sent between beginSnapshot and
+    # endSnapshot are applied by the server as a single batch, so that the
+    # camera is reconfigured only once.
+    def beginSnapshot(self):
+        self.snapshot = []
+
+    def endSnapshot(self):
+        cmds = self.snapshot
+        self.snapshot = None
+
+        if cmds:
+            self.sendCtrl(settingsSnapshot + dumps(cmds))
+
     # Configuring connections to UI update from imgthread.
     def setupThreadingUpdates(self, imgthread):
 
@@ -330,6 +354,8 @@ class DS8Dialog(QDialog, Ui_DSuper8):
     # Sent at startup.
     def sendInitConfig(self):
 
+        self.beginSnapshot()
+
         # Zoom dial setting.
         self.setZoom(self.zoomDial.value())
 
@@ -393,12 +419,20 @@ class DS8Dialog(QDialog, Ui_DSuper8):
         else:
             self.setRaw(False)            
 
+        # Raw transport.
+        self.sendCtrl(rawTransport + ("1" if config.rawBayer else "0"))
+
+        # Raw compression.
+        self.sendCtrl(rawCompression + str(config.rawCompression))
+
         # Capture resolution.
         self.setCapRes(self.resolutionBox.currentIndex())
 
         # Sharpness adjustment.
         self.setSharpness(self.sharpnessBox.value())
 
+        self.endSnapshot()
+
     # Post-capture settings.
     def initPostCapture(self):
 
@@ -904,7 +938,13 @@ class DS8Dialog(QDialog, Ui_DSuper8):
                  " does not exist")
 
         if not configError:
-            self.config.updateUIfromConfig(self)
+            # The settings changed by the configuration file are sent as a
+            # single snapshot.
+            self.beginSnapshot()
+            try:
+                self.config.updateUIfromConfig(self)
+            finally:
+                self.endSnapshot()
             self.configFileBox.setText(str(self.configFile))
             info(str(self.configFile) + " configuration file loaded")
 
@@ -1785,7 +1825,9 @@ class DS8Dialog(QDialog, Ui_DSuper8):
         config.prevOn = False
         config.testImg = False
         config.captureOn = True
-        self.sendCtrl(startCapture)
+        self.sendCtrl(captureRun + str(config.fileNumber) + "," +
+                      str(config.frameLimit) + "," +
+                      str(config.captureCredits))
 
         # Disable controls that affect capture.
         self.disableCaptureWidgets()
@@ -1803,8 +1845,8 @@ class DS8Dialog(QDialog, Ui_DSuper8):
 
         else:
 
-            # Restart capture mode.
-            self.sendCtrl(startCapture)
+            # Restart capture mode. The paused capture run is resumed.
+            self.sendCtrl(captureRun)
             info("Waiting for image " + str(config.numImgRec))
             self.captureStopBtn.setEnabled(True)
             self.updateStatus("Capture mode restarted")
@@ -1924,6 +1966,9 @@ class DS8Dialog(QDialog, Ui_DSuper8):
                 self.imgCapW = 4056
                 self.imgCapH = 3040
 
+        config.capResW = self.imgCapW
+        config.capResH = self.imgCapH
+
         # Capture size and maximum allowed cropping are updated.
         self.setMaxCrop()
 
@@ -27,7 +27,7 @@ from struct import unpack, calcsize
 from logging import info
 
 from numpy import (uint8, shape, clip, array, ndarray, fromstring, bitwise_and,
-                   percentile)
+                   percentile, frombuffer)
 
 from io import BytesIO
 
@@ -37,13 +37,21 @@ from PyQt6.QtCore import QThread, pyqtSignal
 
 from exif import Image
 
+from pidng.core import PICAM2DNG
+
+from pidng.camdefs import Picamera2Camera
+
 from datetime import datetime
 
+from zlib import decompress
+
 # Our own modules.
 
 import config
 
-from codes import newImage
+from codes import newImage, captureCredit, rawHeader, msgMore
+
+from DS8Protocol import readMessage
 
 
 # Class and support functions for the reading and treatment of images.
@@ -101,6 +109,20 @@ class imgThread(QThread):
 
         self.conn = connection
 
+        # Protocol version negotiated with the server.
+        self.version = 1
+
+        # Source of the data of the message being processed.
+        # Protocol 1: the connection. Protocol 2: the payload of the message.
+        self.reader = connection
+
+        # Frame number of the message being processed (protocol 2).
+        self.frame = 0
+
+        # Chunks received of the images sent in several messages, by sequence
+        # number (protocol 2).
+        self.chunks = {}
+
         # Temporary storage of the image received from the server.
         self.imageStream = BytesIO()
 
@@ -171,7 +193,8 @@ class imgThread(QThread):
         
 
     # Rotating and cropping the image.
-    def postProcess(self, img):
+    # scale: size of the image relative to the capture resolution.
+    def postProcess(self, img, scale=1):
 
         h, w = img.shape[:2]
 
@@ -186,8 +209,8 @@ class imgThread(QThread):
 
         # Cropping the image if selected.
         if config.cropping:
-            img = img[config.cropT:h - config.cropB,
-                      config.cropL:w - config.cropR]
+            img = img[int(config.cropT * scale):h - int(config.cropB * scale),
+                      int(config.cropL * scale):w - int(config.cropR * scale)]
 
             # info("Cropped image")
 
@@ -195,11 +218,11 @@ class imgThread(QThread):
 
     # Scaling the image to the maximum dimensions specified in the config.py
     # file.
-    def imageResize(self, img):
+    def imageResize(self, img, scale=1):
         h, w = img.shape[:2]
 
-        config.imgCapIniH = h
-        config.imgCapIniW = w
+        config.imgCapIniH = int(h / scale)
+        config.imgCapIniW = int(w / scale)
 
         self.finalh = config.imgCapFinalH
         self.finalw = int((self.finalh / h) * w)
@@ -380,7 +403,7 @@ class imgThread(QThread):
             else:
                 break
 
-    def finalizeImage(self, img):
+    def finalizeImage(self, img, scale=1):
 
         match config.lastMode:
 
@@ -412,7 +435,7 @@ class imgThread(QThread):
                 self.imageName = self.imageNameRaw        
         
         # Image resize.
-        img = self.imageResize(img)
+        img = self.imageResize(img, scale)
 
         # The image histogram is displayed.
         if config.showHist:
@@ -516,16 +539,22 @@ class imgThread(QThread):
         config.ctrlConn.flush()
         info("Image " + str(config.numImgRec) + " requested")
 
+    # During a capture run the server captures the frames on its own. A credit
+    # is granted for each processed frame, so that the server can continue.
+    def grantCredit(self):
+        config.ctrlConn.write(captureCredit + "\n")
+        config.ctrlConn.flush()
+
     # Processing functions of the information received from the server.
     
     # This function is used to extract images from the stream coming from the
     # server.
     def imgFlag_spab(self):
-        self.exposureTime = unpack("<i", self.conn.read(calcsize("<i")))[0]
-        self.imageLen = unpack("<L", self.conn.read(calcsize("<L")))[0]
+        self.exposureTime = unpack("<i", self.reader.read(calcsize("<i")))[0]
+        self.imageLen = unpack("<L", self.reader.read(calcsize("<L")))[0]
 
         # Save image data to temporary storage.
-        self.imageStream.write(self.conn.read(self.imageLen))
+        self.imageStream.write(self.reader.read(self.imageLen))
         self.imageStream.seek(0)
 
         # File to opencv image.
@@ -533,46 +562,108 @@ class imgThread(QThread):
                                          dtype=uint8), IMREAD_COLOR)
     # Flag e -> automatic exposure time.
     def imgflag_e(self):
-        ssAE = unpack("<l", self.conn.read(calcsize("<l")))[0]
-        again = unpack("<f", self.conn.read(calcsize("<f")))[0]
-        dgain = unpack("<f", self.conn.read(calcsize("<f")))[0]
-        framerate = unpack("<f", self.conn.read(calcsize("<f")))[0]
+        ssAE = unpack("<l", self.reader.read(calcsize("<l")))[0]
+        again = unpack("<f", self.reader.read(calcsize("<f")))[0]
+        dgain = unpack("<f", self.reader.read(calcsize("<f")))[0]
+        framerate = unpack("<f", self.reader.read(calcsize("<f")))[0]
         self.updateAESig.emit(ssAE, again, dgain, framerate)
 
     # Flag f -> exposure time and analog and digital gains.
     def imgFlag_f(self):
-        ss = unpack("<l", self.conn.read(calcsize("<l")))[0]
-        again = unpack("<f", self.conn.read(calcsize("<f")))[0]
-        dgain = unpack("<f", self.conn.read(calcsize("<f")))[0]
-        framerate = unpack("<f", self.conn.read(calcsize("<f")))[0]
+        ss = unpack("<l", self.reader.read(calcsize("<l")))[0]
+        again = unpack("<f", self.reader.read(calcsize("<f")))[0]
+        dgain = unpack("<f", self.reader.read(calcsize("<f")))[0]
+        framerate = unpack("<f", self.reader.read(calcsize("<f")))[0]
         self.updateSSSig.emit(ss, again, dgain, framerate)
 
     # Flag g -> blue and red gains.
     def imgFlag_g(self):
-        gblue = round(unpack("<f", self.conn.read(calcsize("<f")))[0], 2)
-        gred = round(unpack("<f", self.conn.read(calcsize("<f")))[0], 2)
+        gblue = round(unpack("<f", self.reader.read(calcsize("<f")))[0], 2)
+        gred = round(unpack("<f", self.reader.read(calcsize("<f")))[0], 2)
 
         self.updateGainsSig.emit(gblue, gred)
 
     # Flag d -> raw-dng image file.    
     def imgFlag_d(self):        
         
-        self.exposureTime = unpack("<i", self.conn.read(calcsize("<i")))[0]
-        self.imageLen = unpack("<L", self.conn.read(calcsize("<L")))[0]        
+        self.exposureTime = unpack("<i", self.reader.read(calcsize("<i")))[0]
+        self.imageLen = unpack("<L", self.reader.read(calcsize("<L")))[0]        
 
         # Save image data to temporary storage.
-        self.imageStream.write(self.conn.read(self.imageLen))
+        self.imageStream.write(self.reader.read(self.imageLen))
         self.imageStream.seek(0)
 
         info("Raw-dng image " + str(config.numImgRec) + " received" +
              " - " + str(self.imageLen) + " bytes - Exp. time " +
              str(self.exposureTime) + " us")
 
+        self.saveRawImage()
+
+    # Flag r -> raw bayer data. The dng file is assembled here.
+    def imgFlag_r(self):
+
+        self.exposureTime = unpack("<i", self.reader.read(calcsize("<i")))[0]
+        self.imageLen = unpack("<L", self.reader.read(calcsize("<L")))[0]
+
+        self.imageStream.write(self.assembleDng(self.reader.read(self.imageLen)))
+        self.imageStream.seek(0)
+
+        info("Raw bayer image " + str(config.numImgRec) + " received" +
+             " - " + str(self.imageLen) + " bytes - Exp. time " +
+             str(self.exposureTime) + " us")
+
+        self.saveRawImage()
+
+    # Assembling a dng file from the raw bayer data and the metadata sent by
+    # the server.
+    def assembleDng(self, data):
+        headerLen = calcsize(rawHeader)
+        fields = unpack(rawHeader, data[:headerLen])
+
+        width, height, stride = fields[0:3]
+        (level, numStripes, encodeTime) = fields[22:25]
+
+        # Decompression of the raw data.
+        if level:
+            sizesFormat = "<" + str(numStripes) + "I"
+            sizes = unpack(sizesFormat, data[headerLen:headerLen +
+                                             calcsize(sizesFormat)])
+            start = headerLen + calcsize(sizesFormat)
+            stripes = []
+            for size in sizes:
+                stripes.append(decompress(data[start:start + size]))
+                start += size
+            data = b"".join(stripes)
+            headerLen = 0
+
+            info("Raw compression ratio = " +
+                 str(round(len(data) / sum(sizes), 2)) +
+                 " - Server time = " + str(round(encodeTime / 1000)) + " ms")
+
+        rawConfig = {"size": (width, height), "stride": stride,
+                     "format": fields[3].rstrip(b"\0").decode(),
+                     "framesize": stride * height}
+        metadata = {"ExposureTime": fields[4], "AnalogueGain": fields[5],
+                    "DigitalGain": fields[6], "ColourGains": fields[7:9],
+                    "ColourCorrectionMatrix": fields[9:18],
+                    "SensorBlackLevels": fields[18:22]}
+
+        raw = frombuffer(data, dtype=uint8,
+                         offset=headerLen).reshape((height, stride))
+
+        dng = PICAM2DNG(Picamera2Camera(rawConfig, metadata))
+
+        # Without file name, PiDNG returns the dng file.
+        return dng.convert(raw, "")
+
+    # Saving of the received raw image.
+    def saveRawImage(self):
+
         if config.captureRaw and not config.captureJpg:
             
-            # New image is requested from the server.
+            # The server is allowed to capture a new image.
             if (config.captureOn and config.fileNumber < config.frameLimit):
-                self.newImage()
+                self.grantCredit()
 
             else:
                 self.enableCaptureWidgetsSig.emit()       
@@ -647,8 +738,12 @@ class imgThread(QThread):
         if config.prevOn:
             self.newImage()
 
-        self.cvimg = self.postProcess(self.cvimg)
-        self.cvimg = self.finalizeImage(self.cvimg)
+        # Preview images are captured at a lower resolution than the capture
+        # images.
+        scale = self.cvimg.shape[1] / config.capResW
+
+        self.cvimg = self.postProcess(self.cvimg, scale)
+        self.cvimg = self.finalizeImage(self.cvimg, scale)
 
     # Digitized frame with a single image.
     def imgFlag_s(self):
@@ -660,9 +755,9 @@ class imgThread(QThread):
         # The received image number is increased.
         config.numImgRec += 1
 
-        # New image is requested from the server.
+        # The server is allowed to capture a new image.
         if (config.captureOn and config.fileNumber < config.frameLimit):
-            self.newImage()
+            self.grantCredit()
         else:
             self.enableCaptureWidgetsSig.emit()        
 
@@ -723,9 +818,9 @@ class imgThread(QThread):
         # The received image number is increased.
         config.numImgRec += 1
 
-        # New image is requested from the server.
+        # The server is allowed to capture a new image.
         if (config.captureOn and config.fileNumber < config.frameLimit):
-            self.newImage()
+            self.grantCredit()
 
         else:
             self.enableCaptureWidgetsSig.emit()        
@@ -763,6 +858,85 @@ class imgThread(QThread):
             # We increase file number.
             config.fileNumber += 1
 
+    # A message has been discarded. If it was an image, the capture goes on
+    # as if it had been received, so that the server gets its credit and the
+    # file numbers keep matching the frames of the film.
+    def messageLost(self, flag):
+        rawOnly = config.captureRaw and not config.captureJpg
+
+        # Preview: a new image is requested.
+        if flag == "p":
+            if config.prevOn:
+                self.newImage()
+            return
+
+        # Messages that grant the credit of a frame and messages that end it.
+        grants = flag in "sb" or (rawOnly and flag in "dr")
+        ends = flag in "sb" or (rawOnly and flag == "D")
+
+        if grants:
+            if (config.captureOn and config.fileNumber < config.frameLimit):
+                self.grantCredit()
+            else:
+                self.enableCaptureWidgetsSig.emit()
+
+        if ends and config.lastMode == "C":
+            info("Frame " + str(config.fileNumber) + " lost")
+
+            if config.fileNumber >= config.frameLimit:
+                # We finished capture.
+                self.endCaptureSig.emit()
+                # We enable disabled widgets during capture.
+                self.enableCaptureWidgetsSig.emit()
+
+            # We increase file number.
+            config.fileNumber += 1
+
+        # The bracketing images received are discarded with the frame.
+        if flag == "b":
+            self.imglist = []
+            self.indexETM = 0
+
+    # Reading of a protocol 2 message.
+    # The flag is left in self.imgflag and the payload in self.reader.
+    # Returns False if the message must be discarded.
+    def readMessage(self):
+        flag, flags, seq, self.frame, payload = readMessage(self.conn)
+
+        # Connection closed by the server.
+        if flag is None:
+            self.imgflag = "T"
+            return True
+
+        if payload is None:
+            info("Message " + str(seq) + " discarded: checksum error")
+            if flags & msgMore:
+                # The rest of the chunks of the image are also discarded.
+                self.chunks[seq] = None
+            else:
+                self.chunks.pop(seq, None)
+                self.messageLost(flag)
+            return False
+
+        # Chunk of a larger message. It is processed when the last chunk
+        # arrives. Other messages can arrive in between.
+        if seq in self.chunks or flags & msgMore:
+            chunks = self.chunks.setdefault(seq, [])
+            if chunks is not None:
+                chunks.append(payload)
+            if flags & msgMore:
+                return False
+            chunks = self.chunks.pop(seq)
+            if chunks is None:
+                self.messageLost(flag)
+                return False
+            payload = b"".join(chunks)
+
+        self.imgflag = flag
+        self.reader = BytesIO(payload)
+
+        return True
+
     # Imaging thread main loop.
 
     def run(self):
@@ -771,11 +945,16 @@ class imgThread(QThread):
         while True:
 
             # The flag of the information sent by the server is obtained.
-            self.imgflag = self.conn.read(1)
-            try:
-                self.imgflag = self.imgflag.decode()
-            except:
-                continue
+            if self.version >= 2:
+                if not self.readMessage():
+                    continue
+
+            else:
+                self.imgflag = self.conn.read(1)
+                try:
+                    self.imgflag = self.imgflag.decode()
+                except:
+                    continue
 
             # Treatment of data sent by the server.
             match self.imgflag:
@@ -838,6 +1017,14 @@ class imgThread(QThread):
                     self.imageStream.seek(0)
                     self.imageStream.truncate()
 
+                # Flag r -> raw bayer data.
+                case "r":
+                    self.imgFlag_r()
+                    # Clearing the temporary storage of the image received from
+                    # the server.
+                    self.imageStream.seek(0)
+                    self.imageStream.truncate()
+
                 # Flag D -> witness image of raw captures.
                 case "D":
                     self.imgFlag_spab()
@@ -863,6 +1050,17 @@ class imgThread(QThread):
                 case "e":
                     self.imgflag_e()
 
+                # Flag v -> protocol version to be used from now on.
+                case "v":
+                    self.version = unpack("B", self.reader.read(1))[0]
+                    info("Protocol version " + str(self.version))
+
+                # Flag F -> the capture run has failed in the server.
+                case "F":
+                    info("Capture run failed in the server")
+                    if config.captureOn:
+                        self.endCaptureSig.emit()
+
                 # Flag T -> terminate thread execution.
                 case "T":
                     break
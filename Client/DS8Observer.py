@@ -0,0 +1,103 @@
+"""
+DSuper8 project based on Joe Herman's rpi-film-capture.
+
+Software modified by Manuel Ángel.
+
+User interface redesigned by Manuel Ángel.
+
+DS8Observer.py: Read-only viewer of a capture in progress.
+
+It connects to the observer port of the server and shows the reduced copies
+of the frames, together with their exposure data. It does not send commands,
+so it can be used from any machine while the client program is working.
+
+Usage: python3 DS8Observer.py [server address]
+Press q in the image window to exit.
+
+Last version: 20231130.
+"""
+
+from socket import socket, AF_INET, SOCK_STREAM
+
+from struct import unpack
+
+from sys import argv, stdout
+
+from logging import INFO, basicConfig, info
+
+from numpy import frombuffer, uint8
+
+from cv2 import imdecode, imshow, waitKey, destroyAllWindows, IMREAD_COLOR
+
+from DS8Protocol import readMessage
+
+# Our configuration module.
+import config
+
+# Flags of the messages with an image. The observers always receive a jpg
+# image, whatever the format of the image sent to the client.
+imageFlags = "pabsdrD"
+
+
+def main():
+    server = argv[1] if len(argv) > 1 else config.server_ip
+
+    conn = socket(AF_INET, SOCK_STREAM)
+    conn.connect((server, config.observerPort))
+    stream = conn.makefile("rb")
+    info("Observing " + server)
+
+    title = "DSuper8 observer - " + server
+
+    while True:
+        flag, flags, seq, frame, payload = readMessage(stream)
+
+        if flag is None:
+            info("Connection closed by the server")
+            break
+
+        # Checksum error.
+        if payload is None:
+            continue
+
+        # Image: exposure time, size and jpg image.
+        if flag in imageFlags:
+            exposureTime = unpack("<iL", payload[:8])[0]
+            img = imdecode(frombuffer(payload[8:], uint8), IMREAD_COLOR)
+            if img is not None:
+                imshow(title, img)
+            info("Image " + flag + " - Exp. time = " + str(exposureTime) +
+                 " us")
+
+        # Exposure data.
+        elif flag in "ef":
+            exposureTime, ag, dg, fps = unpack("<lfff", payload)
+            info("Exp. time = " + str(exposureTime) + " us - Framerate = " +
+                 str(fps) + " fps - AG = " + str(round(ag, 2)) + " - DG = " +
+                 str(round(dg, 2)))
+
+        # Colour gains.
+        elif flag == "g":
+            gblue, gred = unpack("<ff", payload)
+            info("Gains: blue = " + str(round(gblue, 2)) + ", red = " +
+                 str(round(gred, 2)))
+
+        # Server finished.
+        elif flag in "TX":
+            info("Server finished")
+            break
+
+        if waitKey(1) & 0xFF == ord("q"):
+            break
+
+    stream.close()
+    conn.close()
+    destroyAllWindows()
+
+
+if __name__ == "__main__":
+    # Severity level of the log set to INFO.
+    basicConfig(stream=stdout, level=INFO, format="%(asctime)s - %(levelname)s " +
+                "- %(message)s", datefmt="%Y-%m-%d %H:%M:%S")
+
+    main()
@@ -0,0 +1,48 @@
+"""
+DSuper8 project based on Joe Herman's rpi-film-capture.
+
+Software modified by Manuel Ángel.
+
+User interface redesigned by Manuel Ángel.
+
+DS8Protocol.py: Reading of the protocol 2 messages sent by the server.
+
+Last version: 20231130.
+"""
+
+from struct import calcsize, unpack
+
+from zlib import crc32
+
+from codes import msgHeader, msgMagic, msgPayloadCrc
+
+
+# Reading of a protocol 2 message from a stream.
+# Returns the flag, the header flags, the sequence number, the frame number
+# and the payload. The flag is None if the connection has been closed, and
+# the payload is None if its checksum is not valid.
+def readMessage(stream):
+    headerLen = calcsize(msgHeader)
+    header = stream.read(headerLen)
+
+    if len(header) < headerLen:
+        return (None, 0, 0, 0, None)
+
+    # If the header is not valid, the synchronization has been lost.
+    # The next valid header is searched byte by byte.
+    while (header[:len(msgMagic)] != msgMagic or
+           crc32(header[:-4]) != unpack("<I", header[-4:])[0]):
+        byte = stream.read(1)
+        if not byte:
+            return (None, 0, 0, 0, None)
+        header = header[1:] + byte
+
+    (magic, flag, flags, seq, frame, length, payloadCrc,
+     headerCrc) = unpack(msgHeader, header)
+
+    payload = stream.read(length)
+
+    if flags & msgPayloadCrc and crc32(payload) != payloadCrc:
+        payload = None
+
+    return (flag.decode(), flags, seq, frame, payload)
@@ -14,6 +14,12 @@ Last version: 20231130.
 
 from socket import socket, AF_INET, SOCK_STREAM
 
+from threading import Lock
+
+from struct import pack, calcsize
+
+from zlib import crc32
+
 from pathlib import Path
 
 from sys import argv, stdout, exit
@@ -37,15 +43,61 @@ from DS8Dialogs import DS8Dialog, DS8ImgDialog
 # Class and support functions for the reading and treatment of images.
 from DS8ImgThread import imgThread
 
+from codes import (hello, protocolVersion, msgHeader, msgMagic, msgPayloadCrc,
+                   cmdMessage)
+
+# With a multiplexed connection, the commands are sent as protocol 2 messages
+# through the connection used to receive the images.
+# It replaces the file of the control connection: each line written is sent
+# as a command message when flushed.
+class CommandWriter():
+
+    def __init__(self, sock):
+        self.sock = sock
+
+        # Text written and not yet sent.
+        self.lines = ""
+
+        # Sequence number of the last command sent.
+        self.seq = 0
+
+        # Commands are sent from the UI and from the image thread.
+        self.lock = Lock()
+
+    def write(self, text):
+        with self.lock:
+            self.lines += text
+
+    def flush(self):
+        with self.lock:
+            *commands, self.lines = self.lines.split("\n")
+            for command in commands:
+                self.seq += 1
+                payload = command.encode()
+                header = pack(msgHeader, msgMagic, cmdMessage, msgPayloadCrc,
+                              self.seq, 0, len(payload), crc32(payload),
+                              0)[:-calcsize("<I")]
+                self.sock.sendall(header + pack("<I", crc32(header)) +
+                                  payload)
+
+    def close(self):
+        pass
+
+
 # Creation of 2 connections: one for sending control sequences and another for
 # receiving image data.
+# With a multiplexed connection, only the image connection is created and it
+# is also used for sending control sequences.
 
 def setupConns(image_socket, control_socket):
     try:
         imageSocket.connect((config.server_ip, 8000))
-        controlSocket.connect((config.server_ip, 8001))
         imgConn = imageSocket.makefile("rb")
-        ctrlConn = controlSocket.makefile("w")
+        if config.multiplexed:
+            ctrlConn = CommandWriter(imageSocket)
+        else:
+            controlSocket.connect((config.server_ip, 8001))
+            ctrlConn = controlSocket.makefile("w")
         info("Connections with the server established")
         return (imgConn, ctrlConn)
 
@@ -84,6 +136,10 @@ if __name__ == "__main__":
     (imgConn, ctrlConn) = setupConns(imageSocket, controlSocket)
     config.ctrlConn = ctrlConn
 
+    # Protocol negotiation. The server answers with the version to be used.
+    ctrlConn.write(hello + str(protocolVersion) + "\n")
+    ctrlConn.flush()
+
     # Thread for receiving and processing the images sent by the server.
     imgthread = imgThread(imgConn, app)
 
@@ -25,6 +25,14 @@ from logging import info
 # server_ip = "HAL9005.maodog.es"
 server_ip = "192.168.1.4"
 
+# Single multiplexed connection with the server. Commands and images share the
+# connection on port 8000. Requires a server with protocol 2.
+# If False, two connections are used: images on 8000 and commands on 8001.
+multiplexed = True
+
+# Port of the read-only observer connection, used by DS8Observer.py.
+observerPort = 8002
+
 # GUI theme.
 # GUITheme = "Light"
 GUITheme = "Dark"
@@ -95,6 +103,16 @@ captureOn = False
 captureJpg = True
 captureRaw = False
 
+# Raw transport. If True, the server sends the packed raw bayer data and the
+# dng file is assembled in the client, relieving the Raspberry Pi of this work.
+# Requires PiDNG in the client.
+rawBayer = False
+
+# Lossless compression level of raw images sent by the server.
+# 0 -> no compression, 1 (fastest) to 9 (smallest).
+# Dng files are compressed with lossless jpeg and saved as received.
+rawCompression = 0
+
 # Latest system state.
 # It is used in the image window naming.
 # P -> Preview
@@ -111,12 +129,21 @@ frameNumber = 1
 # Limit number of frames to digitize.
 frameLimit = 3600
 
+# Number of frames that the server can capture ahead of the client during a
+# capture run. A credit is returned to the server for each frame processed.
+captureCredits = 4
+
 # Image file naming index.
 fileNumber = 1
 
 # Image number received from server.
 numImgRec = 1
 
+# Capture resolution configured in the camera. Preview images are captured at
+# the size of the image window, and the cutouts are scaled to them.
+capResW = 2028
+capResH = 1520
+
 # Dimensions of the image initially captured by the camera, once the cutouts
 # have been applied. Obtained in the imageResize function of DS8ImgThread.
 imgCapIniW = 2028
@@ -15,18 +15,34 @@ Latest version: 20231130.
 from socket import (socket, AF_INET, SOCK_STREAM, SHUT_RDWR, SOL_SOCKET,
                     SO_REUSEADDR)
 
-from threading import Thread, Event, Lock
+from select import select
+
+from threading import Thread, Event, Lock, Semaphore, Condition
+
+from collections import deque
+
+from concurrent.futures import ThreadPoolExecutor
 
 from struct import pack
 
+from zlib import crc32
+
+from json import loads
+
 from io import BytesIO
 
+from picamera2 import MappedArray
+
+from simplejpeg import encode_jpeg_yuv_planes
+
+from numpy import ascontiguousarray
+
 # Processes are used to control the stepper motor.
 from multiprocessing import Queue, Event as Evento, Value
 
 from queue import Queue as Cola, Empty
 
-from time import sleep
+from time import sleep, perf_counter
 
 from sys import stdout, exit
 
@@ -37,6 +53,16 @@ from controlProcess import DS8Control, MotorDriver
 
 from camera import DS8Camera
 
+from rawCodec import RawCodec
+
+from preview import PreviewGovernor
+
+from analysis import yuvPlanes
+
+from observers import ObserverHub
+
+from protocol import DS8Link, readMessage
+
 from codes import *
 
 import config
@@ -50,8 +76,12 @@ class DS8Server():
         self.imgcount = 0       
 
         # Compression quality parameter for preview.
+        # It is the upper bound of the quality adapted to the network link.
         self.jpegQualityPr = 60
 
+        # Adaptation of the preview images to the network link.
+        self.previewGovernor = PreviewGovernor(self.jpegQualityPr)
+
         # Compression quality parameter for capture.
         self.jpegQualityCap = 97
 
@@ -62,6 +92,13 @@ class DS8Server():
         # It is activated and deactivated by commands from the client.
         self.autoAdvance = False
 
+        # Capture run in progress or paused.
+        self.captureRun = None
+
+        # Serializes the use of the camera by the commands of the client and
+        # by the thread of the capture run.
+        self.camLock = Lock()
+
         # Main server loop event to stop preview images and image sending
         # threads.
         self.mainExitEvent = Event()
@@ -70,6 +107,10 @@ class DS8Server():
         # Photo capture event.
         self.capEvent = Evento()
 
+        # Motor stopped event.
+        self.motorIdle = Evento()
+        self.motorIdle.set()
+
         # Event to stop the engine process.
         self.motExitEvent = Evento()
 
@@ -83,19 +124,38 @@ class DS8Server():
         # Shared variable. Determines the sending of engine stop signals.
         self.svSendStop = Value("I", 1)
 
+        # Shared variable. Peak pulse frequency in Hz of the last movement of
+        # the motor.
+        self.svMoveSpeed = Value("I", 0)
+
         # Camera instance.
         self.cam = DS8Camera()
 
-        # Connection lock used for sending images.
-        self.connectionLock = Lock()
+        # Lossless compression of raw images.
+        self.rawCodec = RawCodec()
+
+        # Encoding of the jpg images of a bracketing burst.
+        self.encoder = ThreadPoolExecutor(max_workers=config.encodeThreads)
+
+        # Messages of the motor control process to the client.
+        self.motorMessages = Queue()
+
+        # Framing of the messages sent to the client.
+        self.link = DS8Link()
+
+        # Frame number of the images sent. 0 out of capture runs.
+        self.frameNumber = 0
 
         # Motor and lighting control.
-        self.control = DS8Control(self.capEvent, self.motorQueue)
+        self.control = DS8Control(self.capEvent, self.motorIdle,
+                                  self.motorQueue)
 
         # Motor turning process.
-        self.driverprocess = MotorDriver(self.capEvent, self.motExitEvent,
-                                         self.motorQueue, self.connectionLock,
-                                         self.svUpdateFrame, self.svSendStop)
+        self.driverprocess = MotorDriver(self.capEvent, self.motorIdle,
+                                         self.motExitEvent,
+                                         self.motorQueue, self.motorMessages,
+                                         self.svUpdateFrame, self.svSendStop,
+                                         self.svMoveSpeed, self.link)
 
         # Make connections.
         self.imgSocket = socket(AF_INET, SOCK_STREAM)
@@ -107,6 +167,9 @@ class DS8Server():
         self.ctrlSocket.bind(('0.0.0.0', 8001))
         self.ctrlSocket.listen(0)
 
+        # Read-only observers. They can connect at any time.
+        self.observers = ObserverHub(self.mainExitEvent)
+
         # Initiation of connections with the client program.
         self.setupConns(self.imgSocket, self.ctrlSocket)
 
@@ -114,14 +177,26 @@ class DS8Server():
         self.ctrlReader = StreamReader(config.ctrlConn, self.mainExitEvent)
        
         # Thread for sending images.
-        self.imgSendThread = ImageStreamer(self.connectionLock, self.mainExitEvent)
+        self.imgSendThread = ImageStreamer(self.mainExitEvent, self.link,
+                                           self.previewGovernor,
+                                           self.motorMessages)
 
     # Make connections with the client program.
     def setupConns(self, imgSocket, ctrlSocket):
         info("Waiting for connection with the client...")
-        config.imgConn = imgSocket.accept()[0].makefile("wb")
-        config.ctrlConn = ctrlSocket.accept()[0].makefile("r")
-        info("Client connection established")
+        config.imgSock = imgSocket.accept()[0]
+
+        # A client with a single multiplexed connection sends its commands
+        # through the image connection. Otherwise, the client connects the
+        # control connection.
+        if config.imgSock in select([config.imgSock, ctrlSocket], [], [])[0]:
+            config.ctrlConn = config.imgSock.makefile("rb")
+            config.multiplexed = True
+            info("Client multiplexed connection established")
+
+        else:
+            config.ctrlConn = ctrlSocket.accept()[0].makefile("r")
+            info("Client connection established")
 
     # Execution of commands from the client program.
     def processCmd(self, cmdstr):
@@ -136,8 +211,19 @@ class DS8Server():
 
         # New image requested from the client program.
         if cmd == newImage:
+            if self.cam.mode == self.cam.previewing:
+                self.previewGovernor.requested()
             self.newImage()
 
+        # Protocol negotiation.
+        elif cmd == hello:
+            version = min(int(setting), protocolVersion)
+            # The answer is framed with the previous version.
+            self.imgSendThread.queueMessage(
+                self.link.message("v", pack("B", version)))
+            self.link.version.value = version
+            info("Protocol version " + str(version))
+
         # Settings defined in the user interface.
 
         # Initial settings.
@@ -168,7 +254,8 @@ class DS8Server():
         elif cmd == previewOn:
             self.control.lightOn()
             self.sendLightOn()
-            self.cam.mode = self.cam.previewing
+            self.cam.setMode(self.cam.previewing)
+            self.previewGovernor.reset()
 
         elif cmd == previewOff:
             self.control.lightOff()
@@ -204,6 +291,7 @@ class DS8Server():
         # EV
         elif cmd == expComp:            
             self.cam.picam2.controls.ExposureValue = round(float(setting), 1)
+            self.cam.autoExposure.ev = round(float(setting), 1)
 
         # awbBox
         elif cmd == awbMode:
@@ -250,8 +338,8 @@ class DS8Server():
             self.svSendStop.value = 0
             self.control.lightOn()
             self.sendLightOn()
-            self.cam.mode = self.cam.capturing
-            sleep(0.5)
+            self.cam.setMode(self.cam.capturing)
+            self.cam.waitLightStable()
             # Take and send a single photo.
             self.newImage()
             self.control.lightOff()
@@ -302,7 +390,11 @@ class DS8Server():
         # captureStopBtn - capturePauseBtn pressed
         elif cmd == stopCapture:
             # self.autoAdvance = False
-            self.cam.mode = self.cam.off
+            # The capture run stops after the frame in progress.
+            if self.captureRun:
+                self.captureRun.stop()
+            with self.camLock:
+                self.cam.mode = self.cam.off
             self.control.lightOff()
             self.sendLightOff()
 
@@ -315,31 +407,44 @@ class DS8Server():
             self.autoAdvance = True
             self.newImage()
 
+        # captureStartBtn - capturePauseBtn released
+        elif cmd == captureRun:
+            if self.captureRun and self.captureRun.running():
+                info("Capture run already in progress")
+                return
+            if setting:
+                # The previous run, already stopped, is replaced.
+                if self.captureRun:
+                    self.captureRun.stop()
+                first, last, credits = [int(x) for x in setting.split(",")]
+                self.captureRun = CaptureRun(self, first, last, credits)
+            if self.captureRun:
+                self.svSendStop.value = 0
+                self.control.lightOn()
+                self.sendLightOn()
+                with self.camLock:
+                    self.cam.startCaptureMode()
+                self.autoAdvance = True
+                self.captureRun.start()
+
+        # A frame has been processed by the client.
+        elif cmd == captureCredit:
+            if self.captureRun:
+                self.captureRun.grant()
+
         # Advanced settings.
 
         # vflipCheckBox
         elif cmd == vflipOn:
-            self.cam.picam2.stop()
-            self.cam.picam2.still_configuration.transform.vflip = True
-            self.cam.picam2.configure("still")
-            self.cam.picam2.start()
+            self.cam.setFlip(vflip=True)
         elif cmd == vflipOff:
-            self.cam.picam2.stop()
-            self.cam.picam2.still_configuration.transform.vflip = False
-            self.cam.picam2.configure("still")
-            self.cam.picam2.start()
+            self.cam.setFlip(vflip=False)
 
         # hflipCheckBox
         elif cmd == hflipOn:
-            self.cam.picam2.stop()
-            self.cam.picam2.still_configuration.transform.hflip = True
-            self.cam.picam2.configure("still")
-            self.cam.picam2.start()
+            self.cam.setFlip(hflip=True)
         elif cmd == hflipOff:
-            self.cam.picam2.stop()
-            self.cam.picam2.still_configuration.transform.hflip = False
-            self.cam.picam2.configure("still")
-            self.cam.picam2.start()
+            self.cam.setFlip(hflip=False)
 
         # jpgCheckBox
         elif cmd == jpgOn:
@@ -355,6 +460,16 @@ class DS8Server():
         elif cmd == rawOff:
             self.cam.captureRaw = False
 
+        # Raw transport.
+        elif cmd == rawTransport:
+            self.cam.rawBayer = bool(int(setting))
+
+        # Raw compression.
+        elif cmd == rawCompression:
+            self.cam.rawCompression = int(setting)
+            # Lossless jpeg compression inside the dng files.
+            self.cam.picam2.options["compress_level"] = self.cam.rawCompression
+
         # constraintModeBox
         elif cmd == constraintMode:
             self.cam.setConstraintMode(int(setting))
@@ -375,6 +490,18 @@ class DS8Server():
         elif cmd == setSharp:
             self.cam.picam2.controls.Sharpness = round(float(setting), 1)
 
+        # Settings snapshot, sent at startup and when loading a configuration
+        # file. The commands are applied as a single batch.
+        elif cmd == settingsSnapshot:
+            cmds = loads(setting)
+            info("Settings snapshot: " + str(len(cmds)) + " commands")
+            self.cam.beginBatch()
+            try:
+                for c in cmds:
+                    self.processCmd(c)
+            finally:
+                self.cam.endBatch()
+
         # Engine stop signal sending is activated.
         elif cmd == sendStop:
             self.svSendStop.value = 1
@@ -385,10 +512,9 @@ class DS8Server():
         if self.cam.mode == self.cam.previewing:
             
             if not self.cam.autoExp:            
-                self.cam.picam2.controls.ExposureTime = self.cam.ManExposureTime
+                self.cam.scheduler.setExposure(self.cam.ManExposureTime)
             
-            imgflag = "p"
-            self.takeAndQueuePhoto(imgflag)
+            self.takeAndQueuePreview()
             
             if self.cam.autoExp:
                 # Automatic exposure data is sent.
@@ -398,9 +524,26 @@ class DS8Server():
 
         elif self.cam.mode == self.cam.capturing:            
             
-            if self.cam.autoExp:
-                # Calculation of automatic exposure.
-                self.calcExpParmsAE()
+            analyticAE = self.cam.autoExp and config.AEEngine == "analytic"
+
+            if analyticAE:
+                # The exposure time is controlled by the server.
+                self.cam.picam2.controls.AeEnable = False
+
+                # Automatic exposure calculated from the luminance of the
+                # images of the previous frame.
+                self.cam.exposureTime = self.cam.autoExposure.exposureTime()
+                if self.cam.exposureTime is None:
+                    self.cam.exposureTime = self.cam.ManExposureTime
+
+            elif self.cam.autoExp:
+                # The automatic exposure of the camera only converges again
+                # if the scene has changed. Otherwise the previous exposure
+                # time is kept.
+                if not config.AESceneGating or self.cam.autoExposure.update():
+                    # Calculation of automatic exposure.
+                    self.calcExpParmsAE()
+                    self.cam.autoExposure.metered()
                 self.cam.exposureTime = self.cam.AeExposureTime
                 # Automatic exposure data is sent.
                 self.sendSS("e")                   
@@ -408,29 +551,57 @@ class DS8Server():
                 # Manual exposure time.
                 self.cam.exposureTime = self.cam.ManExposureTime
 
-            self.cam.picam2.controls.ExposureTime = self.cam.exposureTime
+            self.cam.scheduler.setExposure(self.cam.exposureTime)
+
+            # Waiting for the stop of the motor, to avoid vibrations.
+            self.control.waitMotor()
 
-            # This loop serves to ensure the stop of the motor and avoid
-            # vibrations.
-            while self.capEvent.is_set():
-                sleep(0.1)
+            # Frames started while the motor was running are discarded.
+            self.cam.scheduler.hold()
+
+            # Waiting for the film to be still after a movement.
+            if config.settleDetection and self.control.moved:
+                self.cam.settleDetector.wait(self.svMoveSpeed.value)
+            self.control.moved = False
+
+            if analyticAE:
+                # Without previous images, the frame is metered.
+                if self.cam.autoExposure.brightness is None:
+                    self.cam.exposureTime = self.cam.autoExposure.meter(
+                        self.cam.exposureTime)
+                    self.cam.scheduler.setExposure(self.cam.exposureTime)
+
+                # Automatic exposure data is sent.
+                self.sendSS("e", exposureTime=self.cam.exposureTime)
 
             if self.cam.captureRaw:
+                
+                if self.cam.rawBayer:
+                    imgflag = "r"
+                    self.takeAndQueueBayer(imgflag)
+                    info("Raw bayer image taken. " + self.exposureInfo())
+                else:
+                    imgflag = "d"
+                    self.takeAndQueueDng(imgflag)
+                    info("Raw dng image taken. " + self.exposureInfo())
+
                 if not self.cam.autoExp:
-                    # Se envían datos de exposición.
+                    # Exposure data of the image is sent.
                     self.sendSS("f")
-                
-                imgflag = "d"
-                self.takeAndQueueDng(imgflag)
-                info("Raw dng image taken. " + self.exposureInfo())
 
                 # This additional image is taken to be displayed in the
                 # client's image window.
                 if not self.cam.captureJpg:
                     imgflag = "D"
-                    self.takeAndQueuePhoto(imgflag)                               
+                    self.takeAndQueuePhoto(imgflag, self.autoAdvance)
+
+            if (self.cam.captureJpg and config.bracketBurst and
+                    self.cam.bracketing > 1):
+
+                # All the shots of the frame are captured in a burst.
+                self.takeAndQueueBracket(self.autoAdvance)
 
-            if self.cam.captureJpg:                
+            elif self.cam.captureJpg:                
 
                 for shot in range(1, self.cam.bracketing + 1):
 
@@ -438,18 +609,18 @@ class DS8Server():
                                                     self.cam.bracketing,
                                                     self.cam.exposureTime)
 
-                    self.cam.picam2.controls.ExposureTime = bracketExposure
-
-                    # The new exposure time is stabilized.
-                    self.stabExpTime(bracketExposure)                    
-
-                    # Exposure data is sent.
-                    self.sendSS("f")                    
+                    # The frame is captured with the new exposure time.
+                    self.cam.scheduler.setExposure(bracketExposure)
 
                     imgflag = ("s" if self.cam.bracketing == 1 else "a"
                                 if shot < self.cam.bracketing else "b")
 
-                    self.takeAndQueuePhoto(imgflag)
+                    # The film is advanced after the last shot of the frame.
+                    self.takeAndQueuePhoto(imgflag, self.autoAdvance and
+                                           shot == self.cam.bracketing)
+
+                    # Exposure data of the image is sent.
+                    self.sendSS("f")
 
                     if imgflag == "s":
                         info("Single image taken. " + self.exposureInfo())
@@ -460,8 +631,10 @@ class DS8Server():
                     elif imgflag == "b":
                         info("Last bracketing image taken. "
                               + self.exposureInfo())            
-           
-            if self.autoAdvance:
+
+            # Without images to capture, the frame is advanced here.
+            if (self.autoAdvance and not self.cam.captureJpg
+                    and not self.cam.captureRaw):
 
                 # Sending the signal to advance one frame.
                 self.control.fwdFrame(1)
@@ -469,59 +642,247 @@ class DS8Server():
         self.imgcount += 1
         info("Sent image " + str(self.imgcount))
 
+    # Take and send all the bracketing images of a frame in a burst of
+    # consecutive frames of the sensor.
+    def takeAndQueueBracket(self, advance):
+
+        exposures = [self.bracketSS(self.cam.stops, shot, self.cam.bracketing,
+                                    self.cam.exposureTime)
+                     for shot in range(1, self.cam.bracketing + 1)]
+
+        self.cam.picam2.options["quality"] = self.jpegQualityCap
+
+        # Images being encoded, in capture order.
+        encoding = []
+
+        burst = self.cam.scheduler.captureBurst(exposures)
+
+        for taken, (shot, request, metadata) in enumerate(burst):
+
+            self.meterImage(request, metadata)
+
+            # The last image of the frame is flagged b. Only the images taken
+            # are counted, because the encoding list holds at most
+            # config.frameBuffers of them.
+            imgflag = "b" if taken == len(exposures) - 1 else "a"
+
+            # All the images are in memory. The film can be advanced.
+            if advance and imgflag == "b":
+                self.control.fwdFrame(1)
+
+            # Images are queued before all the frame buffers are taken.
+            if len(encoding) >= config.frameBuffers:
+                self.queueEncoded(*encoding.pop(0))
+
+            self.observers.publishFrame(request, imgflag,
+                                        metadata.ExposureTime,
+                                        self.frameNumber)
+
+            # Free frame buffer. Blocks if all buffers are in flight.
+            stream = self.imgSendThread.getBuffer()
+
+            encoding.append((self.encoder.submit(self.encodeJpeg, request,
+                                                 stream),
+                             imgflag, stream, metadata))
+
+        for image in encoding:
+            self.queueEncoded(*image)
+
+        # Sending blue and red gains.
+        if self.cam.awb:
+            self.sendGains()
+
+    # The jpg image is encoded and the request released.
+    def encodeJpeg(self, request, stream):
+        request.save("main", stream, format="jpeg")
+        request.release()
+
+    # An encoded bracketing image is queued for sending.
+    def queueEncoded(self, future, imgflag, stream, metadata):
+        future.result()
+
+        self.imgSendThread.queueFrame(imgflag, metadata.ExposureTime, stream,
+                                      self.frameNumber)
+
+        # Exposure data of the image is sent.
+        self.sendSS("f", metadata)
+
+        if imgflag == "a":
+            info("Bracketing image taken. " + self.exposureInfo(metadata))
+        else:
+            info("Last bracketing image taken. " + self.exposureInfo(metadata))
+
     # Take and send a dng file.
     def takeAndQueueDng(self, imgflag):        
+        # Free frame buffer. Blocks if all buffers are in flight.
+        stream = self.imgSendThread.getBuffer()
         
-        # The new exposure time is stabilized.
-        if not self.cam.autoExp:
-            self.stabExpTime(self.cam.exposureTime)
-        
-        # Raw image is captured.
-        request = self.cam.picam2.capture_request()
-        
-        request.save_dng("file.dng")       
+        # Raw image is captured with the requested exposure time.
+        request = self.cam.scheduler.captureRequest()
+        self.meterImage(request)
         
+        # The dng file is built directly in the frame buffer, without writing
+        # it to the SD card.
+        start = perf_counter()
+        request.save_dng(stream)
+        encodeTime = perf_counter() - start
+
+        self.observers.publishFrame(request, imgflag,
+                                    self.cam.metadata.ExposureTime,
+                                    self.frameNumber)
         request.release()
+
+        if self.cam.rawCompression:
+            # Compared with the uncompressed dng, with 16 bits per pixel.
+            width, height = self.cam.picam2.camera_configuration()["raw"]["size"]
+            self.compressionInfo(width * height * 2, stream.tell(), encodeTime)
         
-        # Sending flag.
-        self.imgSendThread.imgflag = imgflag.encode()
-        
-        # Sending dng file.
-        with open("file.dng", "rb") as dngFile:
-            self.imgSendThread.stream.write(dngFile.read())
-        
-        # Sending the exposure time.
-        self.imgSendThread.exposureTime = self.cam.captureMetadata().ExposureTime
-        
-        # Thread start.
-        self.imgSendThread.event.set()        
+        # The frame is queued for sending together with the exposure time.
+        self.imgSendThread.queueFrame(imgflag, self.cam.metadata.ExposureTime,
+                                      stream, self.frameNumber)
 
-    # Take and send a image.
-    def takeAndQueuePhoto(self, imgflag):
+    # Take and send the packed raw bayer data together with the metadata
+    # needed by the client to assemble the dng file.
+    def takeAndQueueBayer(self, imgflag):
 
-        if self.cam.mode == self.cam.capturing:
-            jpegQuality = self.jpegQualityCap
+        # Free frame buffer. Blocks if all buffers are in flight.
+        stream = self.imgSendThread.getBuffer()
 
-        elif self.cam.mode == self.cam.previewing:
-            jpegQuality = self.jpegQualityPr
+        # Raw image is captured with the requested exposure time.
+        request = self.cam.scheduler.captureRequest()
+        self.meterImage(request)
 
-        self.cam.picam2.options["quality"] = jpegQuality
-        
-        # Sending flag.
-        self.imgSendThread.imgflag = imgflag.encode()
+        # Metadata as a dict, with the entries needed by the dng file.
+        metadata = request.get_metadata()
+        rawConfig = self.cam.picam2.camera_configuration()["raw"]
+
+        # Packed bayer data, as delivered by the sensor.
+        raw = request.make_buffer("raw")
+
+        self.observers.publishFrame(request, imgflag, metadata["ExposureTime"],
+                                    self.frameNumber)
+        request.release()
+
+        # Lossless compression in parallel stripes.
+        stripes = []
+        encodeTime = 0
+        if self.cam.rawCompression:
+            start = perf_counter()
+            stripes = self.rawCodec.compress(raw, self.cam.rawCompression)
+            encodeTime = perf_counter() - start
+            self.compressionInfo(raw.nbytes, sum(map(len, stripes)),
+                                 encodeTime)
+
+        width, height = rawConfig["size"]
+        ccm = metadata.get("ColourCorrectionMatrix",
+                           (1, 0, 0, 0, 1, 0, 0, 0, 1))
+        stream.write(pack(rawHeader, width, height, rawConfig["stride"],
+                          str(rawConfig["format"]).encode(),
+                          metadata["ExposureTime"],
+                          metadata["AnalogueGain"],
+                          metadata.get("DigitalGain", 1.0),
+                          *metadata["ColourGains"], *ccm,
+                          *metadata["SensorBlackLevels"],
+                          self.cam.rawCompression, len(stripes),
+                          int(encodeTime * 1e6)))
+
+        if stripes:
+            stream.write(pack("<" + str(len(stripes)) + "I",
+                              *map(len, stripes)))
+            for stripe in stripes:
+                stream.write(stripe)
+        else:
+            stream.write(raw)
+
+        # The frame is queued for sending together with the exposure time.
+        self.imgSendThread.queueFrame(imgflag, metadata["ExposureTime"],
+                                      stream, self.frameNumber)
+
+    # Compression ratio and time of raw images.
+    def compressionInfo(self, rawSize, compressedSize, encodeTime):
+        info("Raw compression ratio = " +
+             str(round(rawSize / compressedSize, 2)) + " - Time = " +
+             str(round(encodeTime * 1000)) + " ms")
+
+    # Take and send a image.
+    # If advance is True, the film is advanced one frame as soon as the image
+    # has been captured, so that the motor runs while the image is encoded and
+    # sent.
+    def takeAndQueuePhoto(self, imgflag, advance=False):
+
+        self.cam.picam2.options["quality"] = self.jpegQualityCap
+
+        # Free frame buffer. Blocks if all buffers are in flight.
+        stream = self.imgSendThread.getBuffer()
         
-        # Capture the jpg image.
-        self.cam.picam2.capture_file(self.imgSendThread.stream, format="jpeg")
+        # Capture the image with the requested exposure time.
+        request = self.cam.scheduler.captureRequest()
+        self.meterImage(request)
+
+        # The image is already in memory. The film can be advanced.
+        if advance:
+            self.control.fwdFrame(1)
+
+        # The jpg image is encoded.
+        request.save("main", stream, format="jpeg")
+
+        self.observers.publishFrame(request, imgflag,
+                                    self.cam.metadata.ExposureTime,
+                                    self.frameNumber)
+        request.release()
         
         # Sending blue and red gains.
         if self.cam.awb:
             self.sendGains()
             
-        # Sending the exposure time.
-        self.imgSendThread.exposureTime = self.cam.captureMetadata().ExposureTime
-        
-        # Thread start.
-        self.imgSendThread.event.set()         
+        # The frame is queued for sending together with the exposure time.
+        self.imgSendThread.queueFrame(imgflag, self.cam.metadata.ExposureTime,
+                                      stream, self.frameNumber)
+
+    # The luminance of the images captured with automatic exposure is
+    # measured to calculate the exposure time of the next frame and to
+    # detect scene changes.
+    def meterImage(self, request, metadata=None):
+        if (self.cam.mode == self.cam.capturing and self.cam.autoExp and
+                (config.AEEngine == "analytic" or config.AESceneGating)):
+            self.cam.autoExposure.measure(request,
+                                          metadata if metadata is not None
+                                          else self.cam.metadata)
+
+    # Take and send a preview image.
+    # The quality and the decimation of the image are adapted to the network
+    # link by the preview governor.
+    def takeAndQueuePreview(self):
+
+        # Free frame buffer. Blocks if all buffers are in flight.
+        stream = self.imgSendThread.getBuffer()
+
+        # With automatic exposure, the camera controls the exposure time.
+        request = self.cam.scheduler.captureRequest(not self.cam.autoExp)
+        self.previewGovernor.captured()
+
+        # The image is taken from the low resolution stream. The YUV planes
+        # are encoded directly, without colour conversion.
+        decimation = self.previewGovernor.decimation
+        with MappedArray(request, "lores") as m:
+            Y, U, V = yuvPlanes(m, request.config["lores"]["size"])
+            Y = ascontiguousarray(Y[::decimation, ::decimation])
+            U = ascontiguousarray(U[::decimation, ::decimation])
+            V = ascontiguousarray(V[::decimation, ::decimation])
+
+        self.observers.publishFrame(request, "p",
+                                    self.cam.metadata.ExposureTime)
+        request.release()
+
+        stream.write(encode_jpeg_yuv_planes(
+            Y, U, V, quality=self.previewGovernor.quality))
+
+        # Sending blue and red gains.
+        if self.cam.awb:
+            self.sendGains()
+
+        self.imgSendThread.queueFrame("p", self.cam.metadata.ExposureTime,
+                                      stream)
 
     # Function for calculating automatic exposure parameters.
     def calcExpParmsAE(self):        
@@ -531,6 +892,7 @@ class DS8Server():
         
         # Reset exposure time.
         self.cam.picam2.controls.ExposureTime = 0
+        self.cam.scheduler.autoExposure()
         
         # Automatic exposure is activated.
         self.cam.picam2.controls.AeEnable = True               
@@ -557,7 +919,7 @@ class DS8Server():
         info("Autoexposure time = " + str(self.cam.AeExposureTime) + 
              " us\n" + " "*29 +
              "Analogue gain = " + 
-             str(self.cam.captureMetadata().AnalogueGain))
+             str(self.cam.metadata.AnalogueGain))
         
         # info("Number of retries = " + str(retries))
         
@@ -588,58 +950,33 @@ class DS8Server():
 
             return exposureTime
         
-    # This function is used to stabilize the exposure time requested from the
-    # camera.
-    def stabExpTime(self, time):
-      # This loop has the function of ensuring that the camera uses
-      # the new exposure time.
-
-      numOfRetries = 0
-
-      for i in range(config.numOfRetries):
-          numOfRetries += 1
-          metadataExposureTime = self.cam.captureMetadata().ExposureTime
-          dif = abs(time - metadataExposureTime)
-          # info("Theoretical exposure time = " +
-          #       str(time) + " us\n" + " "*29 +
-          #       "Camera real time = " +
-          #       str(metadataExposureTime) + " us\n" + " "*29 +
-          #       "Difference = " + str(dif) + " us")
-          if  dif <= config.timeExpTolerance:
-              break
-
-      # info("Number of retries = " + str(numOfRetries))
-        
-
     # Sending the exposure time and analog and digital gains of the camera.
-    def sendSS(self, flag):
+    # The metadata of the last captured frame is used.
+    # The metadata of another frame or the exposure time calculated for the
+    # next one can be given instead.
+    def sendSS(self, flag, metadata=None, exposureTime=None):
 
-        self.cam.metadata = self.cam.captureMetadata()
-        self.cam.frameRate = 1e+6 / self.cam.metadata.FrameDuration
+        if metadata is None:
+            metadata = self.cam.metadata
 
-        with self.connectionLock:
-            # Flag e to point out that it is not an image, but exposure data.
-            config.imgConn.write(flag.encode())
-            config.imgConn.write(pack("<l", self.cam.metadata.ExposureTime))
-            config.imgConn.write(pack("<f", round(self.cam.metadata.AnalogueGain, 2)))
-            config.imgConn.write(pack("<f", round(self.cam.metadata.DigitalGain, 2)))
-            config.imgConn.write(pack("<f", round(self.cam.frameRate, 1)))
-            config.imgConn.flush()
+        if exposureTime is None:
+            exposureTime = metadata.ExposureTime
+
+        # Flag e to point out that it is not an image, but exposure data.
+        self.sendMsg(flag, pack("<lfff", exposureTime,
+                                round(metadata.AnalogueGain, 2),
+                                round(metadata.DigitalGain, 2),
+                                round(1e+6 / metadata.FrameDuration, 1)))
 
     # Sending the gains of the blue and red.
+    # The metadata of the last captured frame is used.
     def sendGains(self):
 
-        self.cam.metadata = self.cam.captureMetadata()
-
         gblue = self.cam.metadata.ColourGains[1]
         gred = self.cam.metadata.ColourGains[0]
 
-        with self.connectionLock:
-            # Flag g to point out that it is not an image, but color gain data.
-            config.imgConn.write("g".encode())
-            config.imgConn.write(pack("<f", gblue))
-            config.imgConn.write(pack("<f", gred))
-            config.imgConn.flush()
+        # Flag g to point out that it is not an image, but color gain data.
+        self.sendMsg("g", pack("<ff", gblue, gred))
 
         gblue = round(gblue, 2)
         gred = round(gred, 2)
@@ -647,29 +984,34 @@ class DS8Server():
         info("Gains data sent to the client: " +
              "blue = " + str(gblue) + ", " + "red = " + str(gred))
     
+    # Sending a message with a small payload.
+    # The observers receive it too.
+    def sendMsg(self, flag, payload=b""):
+        self.imgSendThread.queueMessage(self.link.message(flag, payload,
+                                                          self.frameNumber))
+        self.observers.publish(flag, payload, self.frameNumber)
+
     # Sending notice light on.
     def sendLightOn(self):
-        with self.connectionLock:
-            config.imgConn.write("l".encode())
-            config.imgConn.flush()
+        self.sendMsg("l")
 
     # Sending notice light off.
     def sendLightOff(self):
-        with self.connectionLock:
-            config.imgConn.write("L".encode())
-            config.imgConn.flush()
+        self.sendMsg("L")
 
-    def exposureInfo(self):
+    # Exposure data of the last captured frame.
+    def exposureInfo(self, metadata=None):
 
-        self.cam.metadata = self.cam.captureMetadata()
+        if metadata is None:
+            metadata = self.cam.metadata
 
-        strExpInfo = ("Exp. time = " + str(self.cam.metadata.ExposureTime) +
+        strExpInfo = ("Exp. time = " + str(metadata.ExposureTime) +
                       " us - Framerate = "
-                      + str(round(float(self.cam.frameRate), 1))
+                      + str(round(1e+6 / metadata.FrameDuration, 1))
                       + " fps - AG = "
-                      + str(round(float(self.cam.metadata.AnalogueGain), 2))
+                      + str(round(float(metadata.AnalogueGain), 2))
                       + " - DG = "
-                      + str(round(float(self.cam.metadata.DigitalGain), 2)))
+                      + str(round(float(metadata.DigitalGain), 2)))
                       
 
         return strExpInfo
@@ -680,16 +1022,17 @@ class DS8Server():
     def infExitClient(self):
         # The client is informed.
         # Flag X signal is sent -> application exit.
-        with self.connectionLock:
-            config.imgConn.write("X".encode())
-            config.imgConn.flush()
+        self.sendMsg("X")
 
    # Server shutdown function.
     def exit(self):
+        # Stop the capture run.
+        if self.captureRun:
+            self.captureRun.stop()
+
         # Signal is sent flag T -> terminate imgThread on client.
-        with self.connectionLock:
-            config.imgConn.write("T".encode())
-            config.imgConn.flush()
+        self.sendMsg("T")
+        self.imgSendThread.flush(config.flushTimeout)
 
         # Stop the engine, turn off the light, release the GPIO port.
         self.control.cleanup()
@@ -701,7 +1044,9 @@ class DS8Server():
         self.mainExitEvent.set()
 
         # Event to stop the engine process.
+        # The exit order wakes up the process waiting for orders.
         self.motExitEvent.set()
+        self.motorQueue.put(["x", 0])
 
         # Finish motor turning process.
         self.driverprocess.join()
@@ -712,12 +1057,11 @@ class DS8Server():
         self.cam.picam2.close()        
 
         # Close connections.
-        if config.imgConn:
-            config.imgConn.flush()
-            config.imgConn.close()
         if config.ctrlConn:
             config.ctrlConn.flush()
             config.ctrlConn.close()
+        if config.imgSock:
+            config.imgSock.close()
 
         # Time is allowed for the client to close connections.
         sleep(2)
@@ -728,6 +1072,7 @@ class DS8Server():
         if self.ctrlSocket:
             self.ctrlSocket.shutdown(SHUT_RDWR)
             self.ctrlSocket.close()
+        self.observers.close()
 
         info("Released client connections")
         info("All connections closed")
@@ -739,8 +1084,18 @@ class DS8Server():
         try:
             while not self.mainExitEvent.is_set():
                 data = self.ctrlReader.readline(1)
-                if data:
+                if not data:
+                    continue
+
+                # The commands that control the capture run wait for its
+                # thread, so they are not serialized with it. The rest of
+                # them use the camera.
+                if data[0] in (captureRun, stopCapture, captureCredit,
+                               clientQuit):
                     self.processCmd(data)
+                else:
+                    with self.camLock:
+                        self.processCmd(data)
 
         # Keyboard interrupt.
         except KeyboardInterrupt:
@@ -755,63 +1110,320 @@ class DS8Server():
 
 
 # This class is used to send images to the client program.
+# Captured frames are written in buffers taken from a pool and queued for
+# sending, so that the camera can capture the next frame while the previous
+# ones are still being transmitted. The size of the pool limits the number of
+# frames in flight.
+# It is the only writer of the image connection. The small messages of the
+# server threads and of the motor control process are queued too, and they
+# are sent before the images, or between two chunks of an image.
 class ImageStreamer(Thread):
 
-    def __init__(self, connLock, exitEvent):
+    def __init__(self, exitEvent, link, previewGovernor, motorMessages):
         super(ImageStreamer, self).__init__()
         self.daemon = True
-        self.connLock = connLock        
-        self.stream = BytesIO()
-        self.event = Event()
         self.exitEvent = exitEvent
-        self.imgflag = "s".encode()
-        self.exposureTime = 1000
+        self.link = link
+
+        # The send time of the preview images is measured.
+        self.previewGovernor = previewGovernor
+
+        # Pool of free frame buffers.
+        self.freeBuffers = Cola()
+        for i in range(config.frameBuffers):
+            self.freeBuffers.put(BytesIO())
+
+        # Frames waiting to be sent: (flag, exposure time, buffer, frame).
+        self.sendQueue = Cola()
+
+        # Complete small messages waiting to be sent.
+        self.messages = Cola()
+
+        # Messages of the motor control process. They are forwarded to the
+        # message queue by a separate thread.
+        self.motorMessages = motorMessages
+
+        # Number of queued messages and frames.
+        self.pending = Semaphore(0)
+
+        # Set when everything queued has been sent.
+        self.idle = Event()
+        self.idle.set()
+        self.idleLock = Lock()
+
+        Thread(target=self.forwardMotorMessages, daemon=True).start()
+
         self.start()
 
+    # Get a free frame buffer. Blocks while all buffers are in flight.
+    def getBuffer(self):
+        return self.freeBuffers.get()
+
+    # Queue a captured frame for sending.
+    def queueFrame(self, flag, exposureTime, stream, frame=0):
+        with self.idleLock:
+            self.idle.clear()
+            self.sendQueue.put((flag, exposureTime, stream, frame))
+        self.pending.release()
+
+    # Queue a complete small message for sending.
+    def queueMessage(self, message):
+        with self.idleLock:
+            self.idle.clear()
+            self.messages.put(message)
+        self.pending.release()
+
+    # Waiting for everything queued to be sent.
+    def flush(self, timeout):
+        return self.idle.wait(timeout)
+
+    def forwardMotorMessages(self):
+        while not self.exitEvent.is_set():
+            try:
+                message = self.motorMessages.get(timeout=1)
+            except Empty:
+                continue
+            self.queueMessage(message)
+
     # Main loop. Runs in a separate thread.
     def run(self):
         while not self.exitEvent.is_set():
-            # Waiting for an image to be written to the stream.
-            if self.event.wait():
-                try:
-                    with self.connLock:
-                        self.sendFile(self.imgflag, self.exposureTime,
-                                      self.stream)
-                finally:
-                    self.event.clear()                    
-
-    def sendFile(self, flag, exposureTime, stream):
-        config.imgConn.write(flag)
-        config.imgConn.write(pack("<i", exposureTime))
-        size = stream.tell()        
-        config.imgConn.write(pack("<L", size))
-        config.imgConn.flush()
-        stream.seek(0)
-        config.imgConn.write(stream.read())
-        stream.seek(0)
-        stream.truncate()
+            # Waiting for a message or a frame to be queued.
+            if not self.pending.acquire(timeout=1):
+                continue
+
+            # Messages have priority over frames.
+            try:
+                message = self.messages.get_nowait()
+            except Empty:
+                pass
+            else:
+                sendBuffers(config.imgSock, [message])
+                self.checkIdle()
+                continue
+
+            try:
+                (flag, exposureTime, stream,
+                 frame) = self.sendQueue.get_nowait()
+            except Empty:
+                # Already sent between the chunks of an image.
+                continue
+
+            try:
+                startTime = perf_counter()
+                self.sendFile(flag, exposureTime, stream, frame)
+                if flag == "p":
+                    self.previewGovernor.sent(perf_counter() - startTime)
+            finally:
+                # The buffer is returned to the pool.
+                stream.seek(0)
+                stream.truncate()
+                self.freeBuffers.put(stream)
+
+            self.checkIdle()
+
+    # Sending the messages queued while an image is being sent.
+    def sendMessages(self):
+        while True:
+            try:
+                message = self.messages.get_nowait()
+            except Empty:
+                return
+            self.pending.acquire(blocking=False)
+            sendBuffers(config.imgSock, [message])
+
+    def checkIdle(self):
+        with self.idleLock:
+            if self.messages.empty() and self.sendQueue.empty():
+                self.idle.set()
+
+    # The header and the image are sent directly from the frame buffer,
+    # without intermediate copies.
+    # In protocol 2 the image is sent in chunks, and the queued messages are
+    # sent between chunks, so that they are not delayed by the image.
+    def sendFile(self, flag, exposureTime, stream, frame=0):
+        imgHeader = pack("<iL", exposureTime, stream.tell())
+        with stream.getbuffer() as image:
+
+            if self.link.version.value < 2:
+                header = self.link.header(flag, 0)
+                sendBuffers(config.imgSock, [header, imgHeader, image])
+                return
+
+            seq = self.link.nextSeq()
+            chunks = [imgHeader] + [image[start:start + config.chunkSize]
+                                    for start in range(0, len(image),
+                                                       config.chunkSize)]
+            for i, chunk in enumerate(chunks):
+                crc = crc32(chunk) if config.imageChecksum else None
+                header = self.link.header(flag, len(chunk), frame, crc, seq,
+                                          i < len(chunks) - 1)
+                sendBuffers(config.imgSock, [header, chunk])
+                self.sendMessages()
+
+            # The chunks must not keep the frame buffer exported.
+            del chunks, chunk
+
+
+# Send a list of buffers with as few system calls as possible and without
+# copying them. The socket may accept only part of the data in each call.
+def sendBuffers(sock, buffers):
+    views = [memoryview(buffer).cast("B") for buffer in buffers
+             if len(buffer)]
+    while views:
+        sent = sock.sendmsg(views)
+        while sent:
+            if sent >= len(views[0]):
+                sent -= len(views.pop(0))
+            else:
+                views[0] = views[0][sent:]
+                sent = 0
+
+
+# This class is used to capture a sequence of frames without waiting for the
+# client to request each one of them.
+# The client grants a credit for each processed frame. The server can capture
+# as many frames ahead of the client as credits are available.
+class CaptureRun():
+
+    def __init__(self, server, first, last, credits):
+        self.server = server
+
+        # Next frame to capture and last frame of the run.
+        self.frame = first
+        self.last = last
+
+        # Frames that the server can capture ahead of the client.
+        self.credits = Semaphore(credits)
+
+        # Event to stop the run.
+        self.stopEvent = Event()
+
+        # Capture thread.
+        self.thread = None
+
+    # Start or resume the run in a separate thread.
+    def start(self):
+        if self.thread and self.thread.is_alive():
+            return
+        self.stopEvent.clear()
+        self.thread = Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    # Stop the run after the frame in progress.
+    def stop(self):
+        self.stopEvent.set()
+        if self.thread:
+            self.thread.join()
+
+    def running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    # Credit granted by the client.
+    def grant(self):
+        self.credits.release()
+
+    # Capture loop.
+    def run(self):
+        info("Capture run: frames " + str(self.frame) + " to " +
+             str(self.last))
+        try:
+            while self.frame <= self.last:
+                # Waiting for a credit.
+                while not self.credits.acquire(timeout=0.5):
+                    if self.stopEvent.is_set():
+                        return
+                if self.stopEvent.is_set():
+                    # The credit is kept for the resumed run.
+                    self.credits.release()
+                    return
+                with self.server.camLock:
+                    self.server.frameNumber = self.frame
+                    self.server.newImage()
+                self.frame += 1
+
+        # The client is informed, so that it ends the capture. The run can
+        # not be resumed.
+        except Exception as e:
+            info(getattr(e, 'message', repr(e)))
+            info("Capture run failed")
+            if self.server.captureRun is self:
+                self.server.captureRun = None
+            self.server.sendMsg("F")
+
+        finally:
+            self.server.frameNumber = 0
+            info("Capture run stopped at frame " + str(self.frame))
 
 
 # This class is used for the continuous reading of the orders coming from the
 # client program.
+# Commands that set the value of a control are coalesced: if a newer value of
+# the same control arrives before another kind of command, the older one is
+# not applied. Each control is applied at most once every
+# config.controlInterval s, so that moving a slider does not replay every
+# intermediate value.
 class StreamReader(Thread):
 
+    # Commands that set the value of a control.
+    coalesced = (analogueGain, expComp, gainBlue, gainRed, brightness,
+                 contrast, saturation, setSharp, setX, setY, fixExposure)
+
     def __init__(self, stream, exitEvent):
         super(StreamReader, self).__init__()
         self.daemon = True
         self.stream = stream
-        self.que = Cola()
         self.exitEvent = exitEvent
+
+        # Commands received and not yet read.
+        self.cmds = deque()
+        self.cond = Condition()
+
+        # Time at which each control was last read.
+        self.lastRead = {}
+
+        # Number of commands received.
+        self.received = 0
+
         self.start()
 
+    # A newer value of a control replaces the one waiting to be read, unless
+    # another kind of command has been received after it. Empty commands are
+    # dropped.
+    def put(self, cmd):
+        if not cmd.strip():
+            return
+
+        with self.cond:
+            if cmd[0] in self.coalesced:
+                for i in reversed(range(len(self.cmds))):
+                    if self.cmds[i][0] not in self.coalesced:
+                        break
+                    if self.cmds[i][0] == cmd[0]:
+                        del self.cmds[i]
+                        break
+
+            self.cmds.append(cmd)
+            self.received += 1
+            self.cond.notify()
+
     # Main reading loop.
     def run(self):
         info("Executing command reading thread")
         try:
             while not self.exitEvent.is_set():
+                if config.multiplexed:
+                    # Commands arrive as protocol 2 messages.
+                    (flag, payload) = readMessage(self.stream)
+                    if payload is None:
+                        break
+                    if flag == cmdMessage:
+                        self.put(payload.decode())
+
+                else:
                     line = self.stream.readline()
                     if line:
-                        self.que.put(line)
+                        self.put(line)
 
         except Exception as e:
             info(getattr(e, 'message', repr(e)))
@@ -819,12 +1431,48 @@ class StreamReader(Thread):
         finally:
             info("End of command reading thread")
 
+    # Reading of the next command, waiting up to the given time in s.
+    # A control is not applied again until its interval has elapsed, and
+    # meanwhile newer values can arrive. The commands of another kind are not
+    # delayed: the controls received before them are read at once.
     def readline(self, time=None):
-        try:
-            return self.que.get(block=True, timeout=time)
-
-        except Empty:
-            return None
+        with self.cond:
+            deadline = None if time is None else perf_counter() + time
+
+            while not self.ready():
+                if deadline is not None and perf_counter() >= deadline:
+                    return None
+
+                # The wait ends when the first control can be applied, at the
+                # deadline, or when a new command arrives.
+                ends = [self.due(self.cmds[0])] if self.cmds else []
+                if deadline is not None:
+                    ends.append(deadline)
+                timeout = min(ends) - perf_counter() if ends else None
+
+                received = self.received
+                self.cond.wait_for(lambda: self.received != received,
+                                   timeout)
+
+            cmd = self.cmds.popleft()
+            if cmd[0] in self.coalesced:
+                self.lastRead[cmd[0]] = perf_counter()
+
+            return cmd
+
+    # The first command can be read: it is not a control, another kind of
+    # command has been received after it, or its interval has elapsed.
+    def ready(self):
+        if not self.cmds:
+            return False
+
+        return (self.cmds[0][0] not in self.coalesced or
+                any(cmd[0] not in self.coalesced for cmd in self.cmds) or
+                perf_counter() >= self.due(self.cmds[0]))
+
+    # Time at which a control can be applied again.
+    def due(self, cmd):
+        return self.lastRead.get(cmd[0], 0) + config.controlInterval
 
 
 # Starting the server program.
@@ -0,0 +1,113 @@
+"""
+DSuper8 project based on Joe Herman's rpi-film-capture.
+
+Software modified by Manuel Ángel.
+
+User interface redesigned by Manuel Ángel.
+
+analysis.py: Statistics of the captured images.
+
+Latest version: 20231130.
+"""
+
+from picamera2 import MappedArray
+
+from numpy import float32, ogrid, clip, histogram
+
+# Our configuration module.
+import config
+
+
+# Region of the image (x0, y0, x1, y1) that corresponds to a rectangle
+# (x_offset, y_offset, width, height) given in sensor coordinates.
+# The image covers the ScalerCrop of its metadata.
+def imageRegion(region, scalerCrop, size):
+    cx, cy, cw, ch = scalerCrop
+    rx, ry, rw, rh = region
+    w, h = size
+
+    x0 = int(clip((rx - cx) * w / cw, 0, w))
+    x1 = int(clip((rx + rw - cx) * w / cw, 0, w))
+    y0 = int(clip((ry - cy) * h / ch, 0, h))
+    y1 = int(clip((ry + rh - cy) * h / ch, 0, h))
+
+    # Without intersection the whole image is used.
+    if x1 - x0 < config.AEDecimation or y1 - y0 < config.AEDecimation:
+        return 0, 0, w, h
+
+    return x0, y0, x1, y1
+
+
+# Weights of the metering modes of the camera.
+# 0: CentreWeighted. 1: Spot. 2: Matrix.
+def meteringWeights(shape, meteringMode):
+    h, w = shape
+    y, x = ogrid[-1:1:h * 1j, -1:1:w * 1j]
+    r2 = x * x + y * y
+
+    if meteringMode == 0:
+        return (1 + 3 * clip(1 - r2, 0, 1)).astype(float32)
+
+    elif meteringMode == 1:
+        return (r2 < 0.1).astype(float32)
+
+    return None
+
+
+# Y, U and V planes of the YUV420 low resolution stream of a request.
+# The planes are views of the buffer of the request, only valid inside the
+# MappedArray.
+def yuvPlanes(m, size):
+    w, h = size
+    stride = m.array.shape[1]
+
+    # The U and V planes follow the Y plane, with half the stride.
+    Y = m.array[:h, :w]
+    U = m.array[h:h + h // 4].reshape(h // 2, stride // 2)[:, :w // 2]
+    V = m.array[h + h // 4:h + h // 2].reshape(h // 2, stride // 2)[:, :w // 2]
+
+    return Y, U, V
+
+
+# Decimated luminance of a region (x0, y0, x1, y1) of the low resolution
+# stream of a request, between 0 and 1. None -> whole image.
+def luminance(request, step, region=None):
+    w, h = request.config["lores"]["size"]
+    x0, y0, x1, y1 = region or (0, 0, w, h)
+
+    with MappedArray(request, "lores") as m:
+        Y = yuvPlanes(m, (w, h))[0]
+        return Y[y0:y1:step, x0:x1:step].astype(float32) / 255
+
+
+# Mean linear luminance, between 0 and 1, of the metering region of a
+# request, and normalized histogram of the luminance of the image.
+# The low resolution stream is decimated, so only a small part of the pixels
+# is read.
+def statistics(request, metadata, meteringMode=0):
+    region = imageRegion(config.AEScalerCrop, metadata.ScalerCrop,
+                         request.config["lores"]["size"])
+    luma = luminance(request, config.AEDecimation, region)
+
+    hist = histogram(luma, bins=config.AEHistogramBins, range=(0, 1))[0]
+    hist = hist / luma.size
+
+    # The gamma of the image is removed.
+    luma **= config.AEGamma
+
+    weights = meteringWeights(luma.shape, meteringMode)
+    if weights is None or not weights.sum():
+        return float(luma.mean()), hist
+
+    return float((luma * weights).sum() / weights.sum()), hist
+
+
+# Decimated luminance of the whole image of a request, between 0 and 1.
+def thumbnail(request, step):
+    return luminance(request, step)
+
+
+# Motion between two thumbnails: mean absolute difference relative to the
+# mean luminance.
+def motion(thumb1, thumb2):
+    return float(abs(thumb1 - thumb2).mean() / max(thumb1.mean(), 1e-3))
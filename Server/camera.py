@@ -12,10 +12,21 @@ Latest version: 20231130.
 
 from picamera2 import Picamera2, Metadata
 
-from time import sleep
+from libcamera import Transform
+
+from itertools import product
+
+from time import sleep, perf_counter, monotonic_ns
 
 from logging import info
 
+from exposure import ExposureScheduler, AutoExposure
+
+from settle import SettleDetector
+
+# Our configuration module.
+import config
+
 class DS8Camera():
     off = 0
     previewing = 1
@@ -84,6 +95,15 @@ class DS8Camera():
         # Metadata of the captured images.
         self.metadata = None
 
+        # Exposure time scheduler.
+        self.scheduler = ExposureScheduler(self)
+
+        # Analytic automatic exposure.
+        self.autoExposure = AutoExposure(self)
+
+        # Detection of the vibrations after a film advance.
+        self.settleDetector = SettleDetector(self)
+
         # Camera capture speed in fps.
         self.frameRate = 10
 
@@ -91,12 +111,12 @@ class DS8Camera():
         # These settings are applied with the camera disabled.
         # It's not possible modify them with the camera active.
 
-        # Allocate a single buffer.
-        self.picam2.still_configuration.buffer_count = 1
-
         # Flip the image vertically
-        self.picam2.still_configuration.transform.vflip = True
-        self.picam2.still_configuration.transform.hflip = False
+        self.vflip = True
+        self.hflip = False
+
+        # Index of the capture resolution.
+        self.sizeIdx = 0
 
         # No images in preview.
         self.picam2.still_configuration.display = None
@@ -129,19 +149,45 @@ class DS8Camera():
         # Capture raw images.
         self.captureRaw = False
 
+        # Raw images are sent as packed bayer data instead of dng files.
+        # The dng file is assembled by the client.
+        self.rawBayer = False
+
+        # Lossless compression level of raw images. 0 -> no compression.
+        self.rawCompression = 0
+
         # Unknown parameters.
         # Default configuration.
         self.picam2.still_configuration.main.stride = None
         # self.picam2.still_configuration.framesize = None
-        self.picam2.still_configuration.lores = None        
 
-        # Do not allow queuing images.
-        # The captured image corresponds to the moment of the capture order.
-        # To queue images the buffer_count parameter must be greater than 1.
-        self.picam2.still_configuration.queue = False
+        # Low resolution stream for the preview images and the analysis of the
+        # frames.
+        self.picam2.still_configuration.enable_lores()
+        self.picam2.still_configuration.lores.size = config.loresSize
+        self.picam2.still_configuration.lores.format = ("YUV420")
+
+        # Allow queuing images, so that no frame is lost between two
+        # consecutive captures. The exposure scheduler discards the frames
+        # started before the moment of the capture order.
+        self.picam2.still_configuration.queue = True
+
+        # Configurations used by the program. Preview and capture share the
+        # same configuration: the preview images are taken from the low
+        # resolution stream, so changing between them needs no
+        # reconfiguration of the camera.
+        self.configurations = self.createConfigurations()
+
+        # Key of the configuration loaded in the camera.
+        self.loaded = self.configurationKey()
+
+        # Settings batch. While it is open, the reconfiguration of the camera
+        # is deferred until it is closed.
+        self.batch = False
+        self.reconfigurePending = False
 
         # Loading still image settings.
-        self.picam2.configure("still")
+        self.picam2.configure(self.configurations[self.loaded])
 
         # Camera controls. These parameters can be changed with the
         # camera working.
@@ -223,6 +269,10 @@ class DS8Camera():
         self.customGains = (2.56, 2.23)
         self.picam2.controls.ColourGains = self.customGains
 
+        # Colour gains (red, blue) set in the camera. None if they are
+        # controlled by the automatic white balance.
+        self.colourGains = self.customGains
+
         # Sharpness: value between 0.0 and 16.0. Default 1.0.
         self.picam2.controls.Sharpness = 1.0
 
@@ -256,6 +306,7 @@ class DS8Camera():
             self.awb = True
             self.picam2.controls.AwbEnable = self.awb
             self.picam2.controls.AwbMode = idx
+            self.colourGains = None
         else:
             self.awb = False
             self.picam2.controls.AwbEnable = self.awb
@@ -284,21 +335,34 @@ class DS8Camera():
         info("Adjusted white balance " + mode)
 
     # blueGainBox, redGainBox
+    # The gains set in the camera are kept, so that no frame has to be
+    # waited to know the other gain.
     def fixGains(self, idx, value):
 
-        self.metadata = self.captureMetadata()
+        # After automatic white balance, the gains are those of the camera.
+        if self.colourGains is None:
+            self.metadata = self.captureMetadata()
+            self.colourGains = (round(self.metadata.ColourGains[0], 2),
+                                round(self.metadata.ColourGains[1], 2))
+
+        gred, gblue = self.colourGains
 
         if (idx == 0):
             gred = value
-            gblue = round(self.metadata.ColourGains[1], 2)
 
         elif (idx == 1):
-            gred = round(self.metadata.ColourGains[0], 2)
             gblue = value
 
-        self.picam2.controls.ColourGains = (gred, gblue)
+        self.colourGains = (gred, gblue)
+        self.picam2.controls.ColourGains = self.colourGains
 
-        sleep(0.2)
+        # Waiting for the new gains to be applied before capturing. With
+        # automatic white balance they are not used, and the preview shows
+        # them as soon as they are applied.
+        if not self.awb and self.mode == self.capturing:
+            self.confirmControls(lambda metadata: (
+                abs(metadata.ColourGains[0] - gred) <= config.gainTolerance and
+                abs(metadata.ColourGains[1] - gblue) <= config.gainTolerance))
 
         info("Camera color gains: blue = " + str(gblue) + ", red = " + str(gred))
              
@@ -306,10 +370,121 @@ class DS8Camera():
 
     # captureStartBtn
     def startCaptureMode(self):
-        sleep(1)
-        self.mode = self.capturing
+        self.setMode(self.capturing)
+        self.waitLightStable()
+        # The brightness of the first frame is measured again.
+        self.autoExposure.reset()
         info("Camera in capture mode")
 
+    # Waiting for the light to be stable after switching it on. The light
+    # level estimated by the camera must not change in several consecutive
+    # frames.
+    # Only the frames started after the call are used. The frames already
+    # queued in the camera buffers may have been taken with the light off,
+    # and several of them would look stable.
+    def waitLightStable(self):
+        deadline = perf_counter() + config.lightTimeout
+        flush = monotonic_ns()
+        lastLux = None
+        stableFrames = 0
+
+        while perf_counter() < deadline:
+            self.captureRequest(flush).release()
+            lux = getattr(self.metadata, "Lux", None)
+
+            if lux is None:
+                # Without light estimation, the whole time is waited.
+                sleep(max(deadline - perf_counter(), 0))
+                return
+
+            if (lastLux is not None and
+                    abs(lux - lastLux) <= config.lightTolerance * lastLux):
+                stableFrames += 1
+                if stableFrames >= config.lightStableFrames:
+                    return
+            else:
+                stableFrames = 0
+
+            lastLux = lux
+
+        info("Timeout waiting for the light to be stable")
+
+    # Waiting for the controls to be applied, until the metadata of a frame
+    # satisfies the check.
+    def confirmControls(self, check):
+        deadline = perf_counter() + config.controlTimeout
+
+        while perf_counter() < deadline:
+            if check(self.captureMetadata()):
+                return True
+
+        info("Timeout waiting for the camera controls to be applied")
+        return False
+
+    # Preview and capture use the same configuration, so the camera is not
+    # reconfigured.
+    def setMode(self, mode):
+        self.mode = mode
+
+    # The configurations for every resolution and orientation are created
+    # only once, at startup. They are indexed by
+    # (resolution index, vflip, hflip).
+    def createConfigurations(self):
+        configurations = {}
+
+        for vflip, hflip in product((True, False), repeat=2):
+            self.picam2.still_configuration.transform = Transform(vflip=vflip,
+                                                                  hflip=hflip)
+            for idx, resolution in enumerate(self.resolutions):
+                self.picam2.still_configuration.main.size = resolution
+                self.picam2.still_configuration.sensor.output_size = resolution
+
+                # Several buffers allow capturing consecutive frames of the
+                # sensor.
+                self.picam2.still_configuration.buffer_count = (
+                    config.stillBuffers[idx])
+                configurations[(idx, vflip, hflip)] = (
+                    self.picam2.still_configuration.make_dict())
+
+        return configurations
+
+    def configurationKey(self):
+        return (self.sizeIdx, self.vflip, self.hflip)
+
+    # The resolution or the orientation have changed. The corresponding
+    # configuration is loaded, if it is not already.
+    # libcamera has to stop the camera and allocate the buffers again, so
+    # this is only done when the user changes these settings.
+    def reconfigure(self):
+        if self.batch:
+            self.reconfigurePending = True
+            return
+
+        key = self.configurationKey()
+        if key == self.loaded:
+            return
+
+        self.picam2.switch_mode(self.configurations[key])
+        self.loaded = key
+
+        # The clipping rectangle and the exposure time are set again.
+        self.picam2.controls.ScalerCrop = self.ScalerCrop
+        self.scheduler.reset()
+
+        info("Camera configuration loaded")
+
+    # Settings batch. The controls are set together and the camera is
+    # reconfigured at most once, when the batch is closed.
+    def beginBatch(self):
+        self.batch = True
+        self.reconfigurePending = False
+
+    def endBatch(self):
+        self.batch = False
+        if self.reconfigurePending:
+            self.reconfigurePending = False
+            self.reconfigure()
+
     # Advanced settings.
 
     # constraintModeBox
@@ -345,6 +520,7 @@ class DS8Camera():
     # meteringModeBox
     def setMeteringMode(self, idx):
         self.picam2.controls.AeMeteringMode = idx
+        self.autoExposure.meteringMode = idx
         
         if idx == 0:
             mode = "centre weighted"
@@ -357,13 +533,21 @@ class DS8Camera():
 
         info("Adjusted auto exposure metering mode " + mode)
 
+    # vflipCheckBox, hflipCheckBox
+    # The preview images are flipped as the captured ones.
+    def setFlip(self, vflip=None, hflip=None):
+        if vflip is not None:
+            self.vflip = vflip
+        if hflip is not None:
+            self.hflip = hflip
+
+        self.reconfigure()
+
     # resolutionBox
     def setSize(self, idx):
-        self.picam2.stop()
-        self.picam2.still_configuration.main.size = self.resolutions[idx]        
-        self.picam2.still_configuration.sensor.output_size = self.resolutions[idx]
-        self.picam2.configure("still")
-        self.picam2.start()
+        self.sizeIdx = idx
+        self.reconfigure()
+
         if idx == 0:
             resol = "2028x1520 px"
         elif idx == 1:
@@ -372,7 +556,23 @@ class DS8Camera():
         info("Camera resolution " + resol)   
 
     # This function is used to capture the metadata of the images.
+    # The metadata is kept as the latest known camera state.
     def captureMetadata(self):
         metadata = Metadata(self.picam2.capture_metadata())
 
+        self.metadata = metadata
+        self.frameRate = 1e+6 / metadata.FrameDuration
+
         return metadata
+
+    # Capture of a request. The image and its metadata come from the same
+    # frame. The metadata is kept, so that the exposure data of the image can
+    # be used later without waiting for new frames.
+    # flush: frames started before this time (ns) are discarded.
+    def captureRequest(self, flush=None):
+        request = self.picam2.capture_request(flush=flush)
+
+        self.metadata = Metadata(request.get_metadata())
+        self.frameRate = 1e+6 / self.metadata.FrameDuration
+
+        return request
@@ -116,6 +116,15 @@ stopCapture = "O"
 startCapture = "o"
 newImage = "n"
 
+# captureStartBtn - capturePauseBtn released
+# Capture run: the server captures frames on its own.
+# Setting: first frame, last frame, initial credits.
+# Without setting the paused run is resumed.
+captureRun = "R"
+
+# A credit is granted for each frame processed by the client.
+captureCredit = "+"
+
 # activate engine stop signal
 sendStop = "q"
 
@@ -137,6 +146,21 @@ jpgOff = "J"
 rawOn = "d"
 rawOff = "D"
 
+# Raw transport: 0 -> dng built in the server, 1 -> raw bayer data.
+rawTransport = "B"
+
+# Lossless compression of raw images: 0 -> off, 1 to 9 -> compression level.
+rawCompression = "z"
+
+# Header of the raw bayer data sent by the server (flag r):
+# width, height, stride, sensor format, exposure time, analogue gain,
+# digital gain, colour gains (red, blue), colour correction matrix (3x3),
+# sensor black levels (4), compression level, number of compressed stripes,
+# compression time in us.
+# If compressed, the header is followed by the size of each stripe ("<I") and
+# the zlib compressed stripes.
+rawHeader = "<HHI16siff2f9f4HBHI"
+
 # constraintModeBox
 constraintMode = "T"
 
@@ -151,3 +175,33 @@ setSize = "Z"
 
 # sharpnessBox
 setSharp = "S"
+
+# Settings snapshot: JSON list of commands applied by the server as a single
+# batch. The camera is reconfigured at most once.
+settingsSnapshot = "="
+
+# Protocol
+
+# Highest protocol version supported.
+protocolVersion = 2
+
+# Protocol negotiation. The client sends the highest version it supports.
+# The server answers with flag v followed by the version to be used (one byte).
+hello = "?"
+
+# Protocol 2 message header:
+# magic, flag, header flags, sequence number, frame number, payload length,
+# payload checksum (crc32), header checksum (crc32 of the preceding fields).
+msgMagic = b"D8"
+msgHeader = "<2scBIiIII"
+
+# Header flags.
+# The payload checksum has been computed.
+msgPayloadCrc = 1
+# The payload continues in the next message with the same sequence number.
+# Large images are sent in chunks, so that small messages can overtake them.
+msgMore = 2
+
+# Flag of the commands sent by the client through a multiplexed connection.
+# The payload is the command line.
+cmdMessage = b"k"
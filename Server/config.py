@@ -12,7 +12,10 @@ Latest version: 20231130.
 
 # Global server variables are defined here.
 # pool = []
-imgConn = None
+imgSock = None
+
+# Commands and images share a single connection.
+multiplexed = False
 ctrlConn = None
 ctrlReader = None
 nullFile = "/dev/null"
@@ -21,6 +24,41 @@ nullFile = "/dev/null"
 # AEScalerCrop = (x_offset, y_offset, width, height)
 AEScalerCrop = (310, 330, 3310, 2520)
 
+# Automatic exposure engine in capture mode.
+# "analytic": the exposure time is calculated from the luminance of the images
+# of the previous frame.
+# "libcamera": the automatic exposure algorithm of the camera is used. It has
+# to converge on each frame.
+AEEngine = "analytic"
+
+# Analytic automatic exposure.
+# Target mean linear luminance of the metering area, as in libcamera.
+AETarget = 0.16
+# Gamma of the images, removed to obtain the linear luminance.
+AEGamma = 2.2
+# Only one of every AEDecimation pixels in each direction of the low
+# resolution stream is measured.
+AEDecimation = 4
+# Luminance considered black. It limits the correction of dark images.
+AEMinLuminance = 0.001
+# Metering images without previous frames: maximum number and tolerance in
+# stops.
+AEMaxIterations = 4
+AETolerance = 0.1
+
+# Automatic exposure gated by scene changes.
+# While the scene does not change, the previous exposure is kept as a warm
+# start: the libcamera engine is not run again and the analytic engine
+# smooths the brightness across frames.
+AESceneGating = True
+# Scene change: difference of brightness in stops or distance between the
+# luminance histograms (0 -> equal, 1 -> disjoint).
+AESceneStops = 0.5
+AESceneDistance = 0.25
+AEHistogramBins = 32
+# Weight of the new frame in the smoothed brightness.
+AESmoothing = 0.3
+
 # This variable is used to set the exposure time in bracketed exposures.
 # If the exposure time of the camera differs from the theoretical one by a
 # value lower than that set in the variable, it is accepted as valid.
@@ -30,9 +68,105 @@ timeExpTolerance = 50
 # Number of holding frames required to achieve auto exposure convergence.
 AEWaitFrames = 25
 
-# Number of retries to reach the defined exposure time.
+# Maximum number of frames waited to reach the defined exposure time.
 numOfRetries = 100
 
+# Light stabilization after switching it on: maximum waiting time in s,
+# relative tolerance of the light level estimated by the camera and number
+# of consecutive stable frames.
+lightTimeout = 1
+lightTolerance = 0.02
+lightStableFrames = 2
+
+# Maximum time in s waited for the camera controls to be applied, and
+# tolerance of the colour gains.
+controlTimeout = 0.5
+gainTolerance = 0.02
+
+# Detection of the vibrations of the film after a movement.
+# Motion between two consecutive frames considered still, relative to the
+# mean luminance, maximum waiting time in s, part of the learned settle time
+# skipped without comparing frames and decimation of the compared frames.
+settleDetection = True
+settleThreshold = 0.01
+settleTimeout = 0.5
+settleSkip = 0.5
+settleDecimation = 4
+
+# Number of frames between the request of a new exposure time and the first
+# frame captured with it. The exposure scheduler increases it if necessary,
+# up to maxControlLatency.
+controlLatency = 2
+maxControlLatency = 6
+
+# Bracketing in burst mode: the exposure times of all the shots of a frame are
+# requested on consecutive frames of the sensor. The shots are identified by
+# the exposure time of their metadata and encoded in parallel.
+bracketBurst = True
+
+# Number of camera buffers of the still configuration, for each capture
+# resolution (2028x1520 and 4056x3040).
+# Each buffer holds an RGB image, its raw data and the low resolution image,
+# so this number is limited by the memory reserved for the camera (CMA).
+# A buffer takes about 15 MB at 2028x1520 and 56 MB at 4056x3040, so the
+# default values need about 115 MB of CMA. If the camera cannot be
+# configured, the CMA must be increased, for example with
+# dtoverlay=vc4-kms-v3d,cma-320 in /boot/config.txt.
+stillBuffers = (3, 2)
+
+# Threads that encode the jpg images of a bracketing burst.
+encodeThreads = 3
+
+# Size of the low resolution YUV420 stream that the camera produces together
+# with the main stream. The preview images, of the size of the image window
+# of the client, the automatic exposure and the settle detection use it, so
+# that the full resolution images are only read to be saved.
+loresSize = (864, 648)
+
+# Adaptation of the preview images to the network link.
+# Target preview frame rate, minimum jpg quality, maximum decimation factor of
+# the image and number of images between adaptations.
+previewFps = 10
+previewMinQuality = 30
+previewMaxDecimation = 4
+previewAdaptFrames = 5
+
+# Number of frame buffers in flight between the camera and the network.
+# While a frame is being sent, the following ones can already be captured.
+# Each buffer holds a complete jpg or dng image.
+frameBuffers = 3
+
+# Lossless compression of raw bayer data.
+# The data is split into stripes that are compressed in parallel.
+rawStripes = 16
+compressThreads = 4
+
+# Protocol 2: checksum of the image payloads.
+# The headers and the small messages are always checked.
+imageChecksum = False
+
+# Protocol 2: size of the chunks in which the images are sent.
+# Small messages can be sent between two chunks.
+chunkSize = 262144
+
+# Minimum time in s between two applications of the same camera control.
+# The intermediate values received meanwhile are discarded.
+controlInterval = 0.05
+
+# Read-only observers: port, maximum frame rate, decimation of the low
+# resolution stream and jpg quality of the frames sent to them, and number of
+# messages queued for each observer. The oldest messages are dropped when an
+# observer does not keep up.
+observerPort = 8002
+observerFps = 2
+observerDecimation = 2
+observerQuality = 50
+observerQueue = 8
+
+# Maximum time in s waited for the queued messages and images to be sent
+# when the server exits.
+flushTimeout = 5
+
 # GPIO pin assignment.
 # BCM pin numbering is used.
 
@@ -49,6 +183,16 @@ dirPin = 19
 # Spin pulses.
 pulsePin = 26
 
+# Maximum time in s that the motor process waits for an order before checking
+# the exit event.
+motorQueueTimeout = 0.5
+
+# Maximum time in s waited for the end of a movement of the motor.
+motorTimeout = 30
+
+# Time in s required by the motor driver to wake up or sleep.
+motorWakeTime = 0.002
+
 # Number of steps required to move forward/backward one frame.
 # The stepper motor used is 200 steps per revolution.
 # For smooth operation we use 32 microsteps per step, it has the drawback of
@@ -61,7 +205,25 @@ stepsPerFrame = 3200
 # Frequency in Hz of the pulses to be sent to the motor driver.
 # It should be chosen so that it is as high as possible but without the motor
 # losing steps.
-freq = 8000
+# It is the peak frequency of the movements, reached after an acceleration
+# ramp. The ramps allow higher frequencies than a constant speed start.
+# With the default ramp, a movement of one frame takes 0.38 s.
+freq = 8500
+
+# Acceleration ramp: starting frequency in Hz, acceleration in Hz/s and
+# number of speed levels in which the ramp is divided.
+# The ramps up and down are done within a single frame. If they do not fit in
+# it, the peak frequency is lowered.
+rampFreqStart = 6000
+rampAccel = 80000
+rampLevels = 16
+
+# Time in s between checks of the end of a pulse chain. The next frame of a
+# movement is sent when the previous one ends, so the motor pauses up to this
+# time between frames. The checks start motorPollAhead s before the expected
+# end of the chain.
+motorPollTime = 0.0002
+motorPollAhead = 0.002
 
 # They are used to determine the direction of rotation of the motor.
 backward = False
@@ -10,16 +10,18 @@ controlProcess.py: Control of lighting and motor movement.
 Latest version: 20231130.
 """
 
-from time import sleep
+from time import sleep, perf_counter, process_time
 
 import pigpio
 
 from logging import info
 
-from threading import Lock
-
 from multiprocessing import Process, Event, Queue, Value
 
+from queue import Empty
+
+from motorOrders import motorOrders
+
 # Our configuration module.
 import config
 
@@ -61,13 +63,18 @@ class DS8Control():
     # Image capture event.
     capEvent = Event()
 
+    # Motor stopped event. It is set by the motor control process when a
+    # movement ends.
+    motorIdle = Event()
+
     # Queue for sending orders to the motor control process MotorDriver.
     # The direction of rotation and the number of advance frames will be sent.
     motorQueue = Queue()
 
-    def __init__(self, capEvent, motorQueue):
+    def __init__(self, capEvent, motorIdle, motorQueue):
 
         self.capEvent = capEvent
+        self.motorIdle = motorIdle
         self.motorQueue = motorQueue
 
         # The motor starts. According to tests carried out, it is advisable not
@@ -75,6 +82,9 @@ class DS8Control():
         # precise and smoother if the motor is permanently active.
         self.motorWake()
 
+        # The motor has moved since the last check. The film may vibrate.
+        self.moved = False
+
         # Engine status:
         # 0 -> stop
         # 1 -> advance
@@ -93,6 +103,8 @@ class DS8Control():
         if self.motorstate:
             self.motorStop()
         # cb -> continuous recoil
+        self.motorIdle.clear()
+        self.moved = True
         self.motorQueue.put(["cb", 0])
         self.capEvent.set()
         self.motorstate = -1
@@ -101,9 +113,10 @@ class DS8Control():
     def revFrame(self, num):
         if self.motorstate:
             self.motorStop()
-        while self.capEvent.is_set():
-            sleep(0.5)
+        self.waitMotor()
         # b -> recoil, num -> number of frames
+        self.motorIdle.clear()
+        self.moved = True
         self.motorQueue.put(["b", num])
         self.capEvent.set()
         self.motorstate = -1
@@ -121,9 +134,10 @@ class DS8Control():
     def fwdFrame(self, num):
         if self.motorstate:
             self.motorStop()
-        while self.capEvent.is_set():
-            sleep(0.5)
+        self.waitMotor()
         # f -> advance, num -> number of frames
+        self.motorIdle.clear()
+        self.moved = True
         self.motorQueue.put(["f", num])
         self.capEvent.set()
         self.motorstate = 1
@@ -133,10 +147,17 @@ class DS8Control():
         if self.motorstate:
             self.motorStop()
         # cf -> continuous advance
+        self.motorIdle.clear()
+        self.moved = True
         self.motorQueue.put(["cf", 0])
         self.capEvent.set()
         self.motorstate = 1
 
+    # Waiting for the end of the movement of the motor.
+    def waitMotor(self):
+        if not self.motorIdle.wait(config.motorTimeout):
+            info("Timeout waiting for the motor to stop")
+
     def cleanup(self):
         self.lightOff()
         self.motorStop()
@@ -147,12 +168,12 @@ class DS8Control():
     def motorWake(self):
         pi.write(sleepPin, enabled)
         info("Motor on")
-        sleep(0.5)
+        sleep(config.motorWakeTime)
 
     def motorSleep(self):
         pi.write(sleepPin, disabled)
         info("Motor off")
-        sleep(0.5)
+        sleep(config.motorWakeTime)
 
 # Very simple class designed to advance frames in another process during
 # captures, so a different kernel can handle it and will not delay the
@@ -162,6 +183,9 @@ class MotorDriver(Process):
     # Photo capture event.
     capEvent = Event()
 
+    # Motor stopped event.
+    motorIdle = Event()
+
     # Application exit event.
     appExitEvent = Event()
 
@@ -170,8 +194,9 @@ class MotorDriver(Process):
     # received.
     motorQueue = Queue()
 
-    # Blocking the connection used for sending images.
-    connectionLock = Lock()
+    # Queue for sending messages to the client. They are sent by the image
+    # sending thread of the server, the only writer of the connection.
+    motorMessages = Queue()
 
     # Shared variable.This variable determines the sending of forward and
     # backward signals of frames, for updating the client's position indicator.
@@ -184,23 +209,27 @@ class MotorDriver(Process):
     # 1 -> send stop signals
     svSendStop = Value("I", 1)
 
-    def __init__(self, capEvent, motExitEvent, motorQueue, connectionLock,
-                  svUpdateFrame, svSendStop):
+    # Shared variable. Peak pulse frequency in Hz of the last movement. The
+    # vibrations of the film after the movement depend on it.
+    svMoveSpeed = Value("I", 0)
+
+    def __init__(self, capEvent, motorIdle, motExitEvent, motorQueue,
+                 motorMessages, svUpdateFrame, svSendStop, svMoveSpeed,
+                 link):
         super(MotorDriver, self).__init__()
         info("Starting MotorDriver")
 
         self.capEvent = capEvent
+        self.motorIdle = motorIdle
         self.motExitEvent = motExitEvent
         self.motorQueue = motorQueue
-        self.connectionLock = connectionLock
+        self.motorMessages = motorMessages
         self.svUpdateFrame = svUpdateFrame
         self.svSendStop = svSendStop
+        self.svMoveSpeed = svMoveSpeed
 
-        # Pulse wave identifier.
-        self.wid = 0
-
-        # Pulse chain.
-        self.chain = []
+        # Framing of the messages sent to the client.
+        self.link = link
 
         # Number of steps required to move forward/backward one frame.
         # For smooth operation we use 32 microsteps per step, has the
@@ -209,9 +238,12 @@ class MotorDriver(Process):
         # needed to advance one frame.
         self.stepsPerFrame = config.stepsPerFrame
 
-        # Parameters used to create the pulse chain.
-        self.x = self.stepsPerFrame % 256
-        self.y = int(self.stepsPerFrame / 256)
+        # Speed levels of the acceleration ramp: (wave identifier, period of
+        # the pulses in us).
+        self.levels = []
+
+        # Steps at each speed level while accelerating to the next one.
+        self.rampSteps = []
 
         # They are used to determine the direction of rotation of the motor.
         self.backward = config.backward
@@ -227,70 +259,101 @@ class MotorDriver(Process):
         # advance/reverse.
         self.numframes = 0
 
-        # Engine advance pulse chain.
-        self.createChain()
-
-        # Frame advance time in s.
-        self.tFrameAdv = config.stepsPerFrame * pi.wave_get_micros() * 1e-6
-
-    # Definition of the motor advance pulse chain.
-    def createChain(self):
+        # Waves of the speed levels.
+        self.createWaves()
 
-        # We create the pulses that make up the wave.
-        pul = []
+        # Peak speed level of the movements.
+        self.top = self.topLevel()
 
-        # Time in us of a half-period of the wave.
-        tus = int(500000 / config.freq)
-
-        # pin ON
-        pul.append(pigpio.pulse(1 << pulsePin, 0, tus))
-
-        # pin OFF
-        pul.append(pigpio.pulse(0, 1 << pulsePin, tus))
+    # Definition of the waves of the speed levels of the acceleration ramp.
+    # The speed increases linearly, with constant acceleration, from the
+    # starting frequency to the peak frequency.
+    def createWaves(self):
 
         # We clean pre-existing waves.
         pi.wave_clear()
 
-        # We add the previously created pulses.
-        pi.wave_add_generic(pul)
-
-        # We create the wave.
-        self.wid = pi.wave_create()
-
-        # Chain of pulses required to advance one frame.
-        self.chain += [255, 0, self.wid, 255, 1, self.x, self.y]
+        numLevels = max(config.rampLevels, 1)
+        freqs = [config.freq if numLevels == 1 else
+                 config.rampFreqStart + (config.freq - config.rampFreqStart)
+                 * k / (numLevels - 1) for k in range(numLevels)]
+
+        for freq in freqs:
+
+            # Time in us of a half-period of the wave.
+            tus = int(500000 / freq)
+
+            # pin ON, pin OFF
+            pi.wave_add_generic([pigpio.pulse(1 << pulsePin, 0, tus),
+                                 pigpio.pulse(0, 1 << pulsePin, tus)])
+
+            self.levels.append((pi.wave_create(), 2 * tus))
+
+        # v² = v0² + 2 a n
+        self.rampSteps = [max(1, round((freqs[k + 1]**2 - freqs[k]**2) /
+                                       (2 * config.rampAccel)))
+                          for k in range(numLevels - 1)]
+
+    # Peak speed level of the movements. The speed ramps up and down within
+    # a single frame, so the ramps of a movement of one frame must fit in it.
+    def topLevel(self):
+        top = len(self.levels) - 1
+        while top and 2 * sum(self.rampSteps[:top]) > self.stepsPerFrame:
+            top -= 1
+
+        return top
+
+    # Speed profile of a frame of a movement: list of (level, steps).
+    # The speed ramps up to the peak level if the frame is the first one, and
+    # ramps down to rest at the end of the frame if it is the last one.
+    def frameProfile(self, first, last):
+        ramp = [(k, self.rampSteps[k]) for k in range(self.top)]
+        rampUp = ramp if first else []
+        rampDown = ramp[::-1] if last else []
+        cruise = self.stepsPerFrame - sum(steps for level, steps in
+                                          rampUp + rampDown)
+
+        return rampUp + [(self.top, cruise)] + rampDown
+
+    # Pulse chain of a speed profile. Each loop repeats a wave up to 65535
+    # times.
+    def chainOf(self, profile):
+        chain = []
+        for level, steps in profile:
+            wid = self.levels[level][0]
+            while steps > 0:
+                n = min(steps, 65535)
+                chain += [255, 0, wid, 255, 1, n % 256, n // 256]
+                steps -= n
+
+        return chain
+
+    # Duration in s of a speed profile.
+    def duration(self, profile):
+        return sum(steps * self.levels[level][1] for level, steps in
+                   profile) * 1e-6
 
     # Main control loop of motor rotation.
+    # The process sleeps while waiting for orders.
     def run(self):
         info("Running motor turn process")
+        startTime = perf_counter()
         try:
-            while not self.motExitEvent.is_set():
+            for msg in motorOrders(self.motorQueue, self.motExitEvent):
 
-                if not self.motorQueue.empty():
-                    msg = self.motorQueue.get()
-                    self.order = msg[0]
-                    self.numframes = msg[1]
-                else:
-                    continue
+                self.order = msg[0]
+                self.numframes = msg[1]
 
                 if self.order == "f":
                     pi.write(dirPin, self.forward)
                     self.turnFrames(self.numframes, "f")
-                    # Motor stopped.
-                    info("Motor stop")
-                    self.capEvent.clear()
-                    if self.svSendStop.value:
-                        self.sendFrameMove("m")
+                    self.motorStopped()
 
                 elif self.order == "cf":
                     pi.write(dirPin, self.forward)
                     self.turn = True
                     self.continuousTurn("f")
-                    # Motor stopped.
-                    info("Motor stop")
-                    self.capEvent.clear()
-                    if self.svSendStop.value:
-                        self.sendFrameMove("m")
+                    self.motorStopped()
 
                 # In order to eliminate the small error that originates from
                 # vertical scrolling when moving back frames, go back one
@@ -302,11 +365,7 @@ class MotorDriver(Process):
                     sleep(0.5)
                     pi.write(dirPin, self.forward)
                     self.turnFrames(1, "f")
-                    # Motor stopped.
-                    info("Motor stop")
-                    self.capEvent.clear()
-                    if self.svSendStop.value:
-                        self.sendFrameMove("m")
+                    self.motorStopped()
 
                 elif self.order == "b":
                     pi.write(dirPin, self.backward)
@@ -314,11 +373,7 @@ class MotorDriver(Process):
                     sleep(0.5)
                     pi.write(dirPin, self.forward)
                     self.turnFrames(1, "f")
-                    # Motor stopped.
-                    info("Motor stop")
-                    self.capEvent.clear()
-                    if self.svSendStop.value:
-                        self.sendFrameMove("m")
+                    self.motorStopped()
 
                 elif self.order == "s":
                     self.turn = False
@@ -327,7 +382,22 @@ class MotorDriver(Process):
             info(getattr(e, 'message', repr(e)))
 
         finally:
-            info("End of the motor turning process")
+            # CPU usage of the process during the session.
+            cpuTime = process_time()
+            elapsedTime = perf_counter() - startTime
+            info("End of the motor turning process. CPU time = " +
+                 str(round(cpuTime, 2)) + " s in " +
+                 str(round(elapsedTime, 1)) + " s (" +
+                 str(round(100 * cpuTime / elapsedTime, 1)) + " %)")
+
+    # Motor stopped. The processes waiting for the end of the movement are
+    # notified.
+    def motorStopped(self):
+        info("Motor stop")
+        self.capEvent.clear()
+        self.motorIdle.set()
+        if self.svSendStop.value:
+            self.sendFrameMove("m")
 
     def turnFrames(self, numframes, direction):
         if direction == "f":
@@ -342,19 +412,8 @@ class MotorDriver(Process):
             else:
                 info(str(numframes) + " frames reverse")
 
-        for i in range(numframes):
-            self.motorTurn()
-            if direction == "f" and self.svUpdateFrame.value:
-                self.sendFrameMove("c")
-            elif direction == "b" and self.svUpdateFrame.value:
-                self.sendFrameMove("C")
-
-            # We check stop order.
-            if not self.motorQueue.empty():
-                msg = self.motorQueue.get()
-                self.order = msg[0]
-                if self.order == "s":
-                    break
+        if numframes > 0:
+            self.move(numframes, direction)
 
     def continuousTurn(self, direction):
         if direction == "f":
@@ -362,35 +421,80 @@ class MotorDriver(Process):
         elif direction == "b":
             info("Continuous reverse motor")
 
-        # Continuous turning is done by full frames.
-        while self.turn:
-            self.motorTurn()
-            if direction == "f" and self.svUpdateFrame.value:
-                self.sendFrameMove("c")
-            elif direction == "b" and self.svUpdateFrame.value:
-                self.sendFrameMove("C")
-
-            # We check stop order.
-            if not self.motorQueue.empty():
-                msg = self.motorQueue.get()
-                self.order = msg[0]
-                if self.order == "s":
-                    self.turn = False
-                else:
-                    continue
+        # The motor accelerates once and keeps the peak speed until the stop
+        # order arrives.
+        self.move(None, direction)
+        self.turn = False
 
-    def motorTurn(self):
-        # We send the chain for the advance of a frame.
-        pi.wave_chain(self.chain)
-        sleep(self.tFrameAdv)
+    # Waiting until a time given by perf_counter, or until a stop or exit
+    # order is received. Returns True if the movement must be stopped.
+    # The rest of orders are not expected during a movement, and they are
+    # discarded.
+    def stopOrder(self, untilTime=0):
+        try:
+            msg = self.motorQueue.get(timeout=max(untilTime - perf_counter(),
+                                                  0))
+        except Empty:
+            return False
+
+        self.order = msg[0]
+        return self.order in ("s", "x")
+
+    # Waiting for the end of the running pulse chain, expected at a time given
+    # by perf_counter. The end is checked from config.motorPollAhead s before.
+    def waitChain(self, endTime):
+        delay = endTime - config.motorPollAhead - perf_counter()
+        if delay > 0:
+            sleep(delay)
+
+        while pi.wave_tx_busy():
+            sleep(config.motorPollTime)
+
+    # Movement of a number of frames, or continuous if numframes is None.
+    # Each frame is sent as a pulse chain as soon as the previous one ends, so
+    # the motor keeps the peak speed between frames and the frames done are
+    # known exactly. The speed ramps up in the first frame and down in the
+    # last one, which ends at rest on the frame boundary.
+    # A chain is never stopped while running. When a stop order arrives, the
+    # next frame is the last one.
+    # Returns True if the movement has been stopped by an order.
+    def move(self, numframes, direction):
+        self.svMoveSpeed.value = round(1e6 / self.levels[self.top][1])
+
+        stopped = False
+        frames = 0
+        while True:
+            frames += 1
+            last = stopped or frames == numframes
+            profile = self.frameProfile(frames == 1, last)
+
+            pi.wave_chain(self.chainOf(profile))
+            endTime = perf_counter() + self.duration(profile)
+
+            # Stop orders are received while the frame is running.
+            while (not last and not stopped and
+                   perf_counter() < endTime - config.motorPollAhead):
+                stopped = self.stopOrder(endTime - config.motorPollAhead)
+
+            self.waitChain(endTime)
+            self.frameSignal(direction)
+
+            if last:
+                if stopped:
+                    info("Motor stopped by order")
+                return stopped
+
+    # Frame movement signal, for updating the client's position indicator.
+    def frameSignal(self, direction):
+        if direction == "f" and self.svUpdateFrame.value:
+            self.sendFrameMove("c")
+        elif direction == "b" and self.svUpdateFrame.value:
+            self.sendFrameMove("C")
 
     # Sending forward or backward frame movement signal.
     def sendFrameMove(self, flag):
 
-        with self.connectionLock:
-
-            config.imgConn.write(flag.encode())
-            config.imgConn.flush()
+        self.motorMessages.put(self.link.message(flag))
 
         if flag == "c":
             info("Frame advance signal sent")
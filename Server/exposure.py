@@ -0,0 +1,303 @@
+"""
+DSuper8 project based on Joe Herman's rpi-film-capture.
+
+Software modified by Manuel Ángel.
+
+User interface redesigned by Manuel Ángel.
+
+exposure.py: Exposure control of the captured frames.
+
+Latest version: 20231130.
+"""
+
+from time import monotonic_ns
+
+from math import log2
+
+from logging import info
+
+from analysis import statistics
+
+# Our configuration module.
+import config
+
+
+# The exposure time requested from the camera is applied a fixed number of
+# frames later (control latency). Each request carries in its metadata the
+# exposure time it was captured with.
+# The scheduler skips directly to the first frame that can have the new
+# exposure time and checks it with the metadata of the request, instead of
+# polling the camera metadata until the exposure time is reached.
+class ExposureScheduler():
+
+    def __init__(self, cam):
+        self.cam = cam
+
+        # Control latency in frames. It is increased if a frame arrives before
+        # the requested exposure time has been applied.
+        self.latency = config.controlLatency
+
+        # Exposure time requested. None if it is controlled by the automatic
+        # exposure algorithm of the camera.
+        self.exposureTime = None
+
+        # Time of the last exposure time request (ns).
+        self.requestTime = 0
+
+        # Frames started before this time (ns) are discarded.
+        self.notBefore = 0
+
+    # Request of a new exposure time.
+    def setExposure(self, exposureTime):
+        if exposureTime != self.exposureTime:
+            self.cam.picam2.controls.ExposureTime = exposureTime
+            self.exposureTime = exposureTime
+            self.requestTime = monotonic_ns()
+
+    # The exposure time is controlled by the automatic exposure algorithm.
+    def autoExposure(self):
+        self.exposureTime = None
+
+    # The exposure time of the camera is unknown after loading a
+    # configuration. It is requested again.
+    def reset(self):
+        self.exposureTime = None
+        self.requestTime = 0
+
+    # Frames started before now are discarded. It is used after the motor
+    # stops.
+    def hold(self):
+        self.notBefore = monotonic_ns()
+
+    # Exposure time that the sensor can reach for a requested one. The
+    # exposure times out of the limits of the sensor are clamped to them.
+    def reachable(self, exposureTime):
+        minExpTime, maxExpTime = (
+            self.cam.picam2.camera_controls["ExposureTime"][:2])
+
+        return min(max(exposureTime, minExpTime), maxExpTime)
+
+    # The frame has been captured with the requested exposure time, or with
+    # the value to which the sensor clamps it.
+    def reached(self, metadata, exposureTime):
+        return (abs(metadata.ExposureTime - self.reachable(exposureTime)) <=
+                config.timeExpTolerance)
+
+    # Capture of a request with the requested exposure time.
+    # If verify is False, the exposure time of the request is not checked.
+    def captureRequest(self, verify=True):
+        frameDuration = 1e+9 / self.cam.frameRate
+        expected = int(self.requestTime + self.latency * frameDuration)
+        flush = max(self.notBefore, expected)
+
+        for i in range(config.numOfRetries):
+            request = self.cam.captureRequest(flush)
+
+            if (not verify or self.exposureTime is None or
+                    self.reached(self.cam.metadata, self.exposureTime)):
+                # The exposure time arrived i frames later than expected
+                # from the control latency. The latency is only increased
+                # when the first frame was waited because of it.
+                if i and expected >= self.notBefore:
+                    self.increaseLatency(i)
+                return request
+
+            # The frame was captured before the new exposure time was
+            # applied.
+            request.release()
+            flush = 0
+
+        info("Requested exposure time not reached")
+        return self.cam.captureRequest()
+
+    # The control latency is increased, up to config.maxControlLatency.
+    def increaseLatency(self, frames):
+        latency = min(self.latency + frames, config.maxControlLatency)
+        if latency != self.latency:
+            self.latency = latency
+            info("Exposure control latency = " + str(self.latency) +
+                 " frames")
+
+    # Burst capture of several exposure times on consecutive frames.
+    # Each exposure time is requested one frame after the previous one, so
+    # all the shots arrive in about as many frame periods as shots.
+    # Yields (shot, request, metadata) in the order in which the shots are
+    # captured. The request must be released by the caller.
+    def captureBurst(self, exposures):
+        pending = dict(enumerate(exposures))
+        toRequest = list(pending)
+
+        self.setExposure(exposures[toRequest.pop(0)])
+        frameDuration = 1e+9 / self.cam.frameRate
+        flush = max(self.notBefore,
+                    int(self.requestTime + self.latency * frameDuration))
+
+        for i in range(config.numOfRetries):
+            if not pending:
+                return
+
+            request = self.cam.captureRequest(flush)
+            flush = 0
+            metadata = self.cam.metadata
+
+            # The exposure time of a following frame is requested. The shots
+            # not captured yet are requested again at the end of the ladder.
+            if not toRequest:
+                toRequest = list(pending)
+            self.setExposure(exposures[toRequest.pop(0)])
+
+            # The shot is identified by the exposure time of the frame.
+            shot = min(pending, key=lambda shot:
+                       abs(metadata.ExposureTime -
+                           self.reachable(pending[shot])))
+
+            if self.reached(metadata, pending[shot]):
+                del pending[shot]
+                yield shot, request, metadata
+            else:
+                request.release()
+
+        info("Requested exposure time not reached")
+
+        for shot in list(pending):
+            del pending[shot]
+            request = self.cam.captureRequest()
+            yield shot, request, self.cam.metadata
+
+
+# Automatic exposure calculated from the luminance of the captured images.
+# The scene brightness measured in the images of a frame gives directly the
+# exposure time of the next one, without waiting for the convergence of the
+# automatic exposure algorithm of the camera.
+# Consecutive frames of a shot are nearly identical. While the scene does not
+# change, the brightness is smoothed across frames to avoid flicker, and the
+# automatic exposure of the camera is not run again.
+class AutoExposure():
+
+    def __init__(self, cam):
+        self.cam = cam
+
+        # Exposure compensation in stops.
+        self.ev = 0
+
+        # Metering mode. 0: centre weighted, 1: spot, 2: matrix.
+        self.meteringMode = 0
+
+        self.reset()
+
+    # The brightness of the scene is unknown. It is measured again before
+    # the next capture.
+    def reset(self):
+        # Linear luminance per unit of exposure (us) and gain.
+        self.brightness = None
+
+        # Best measurement of the current frame:
+        # (error in stops, brightness, histogram).
+        self.measurement = None
+
+        # Brightness and histogram of the scene when it was last metered.
+        self.reference = None
+
+    # Measurement of the luminance of a captured image.
+    # Of the images of a frame, the one closest to the target luminance is
+    # used, since it has the least clipped and noisy pixels.
+    def measure(self, request, metadata):
+        y, hist = statistics(request, metadata, self.meteringMode)
+        y = min(max(y, config.AEMinLuminance), 1)
+
+        error = abs(log2(y / config.AETarget))
+        if self.measurement is None or error < self.measurement[0]:
+            self.measurement = (error, y / (metadata.ExposureTime *
+                                            metadata.AnalogueGain *
+                                            metadata.DigitalGain), hist)
+
+    # Scene change: the brightness or the histogram of the images differ too
+    # much from those of the scene when it was last metered.
+    def sceneChange(self, brightness, hist):
+        refBrightness, refHist = self.reference
+
+        stops = abs(log2(brightness / refBrightness))
+        distance = abs(hist - refHist).sum() / 2
+
+        return (stops > config.AESceneStops or
+                distance > config.AESceneDistance)
+
+    # The measurement of the images of the previous frame is taken.
+    # Returns True if the scene has changed and must be metered again.
+    def update(self):
+        if self.measurement is None:
+            return self.brightness is None
+
+        error, brightness, hist = self.measurement
+        self.measurement = None
+
+        if self.brightness is None or not config.AESceneGating:
+            changed = True
+
+        elif self.reference is None:
+            # First images after metering the scene.
+            self.reference = (brightness, hist)
+            changed = False
+
+        else:
+            changed = self.sceneChange(brightness, hist)
+
+        if changed:
+            if self.brightness is not None and config.AESceneGating:
+                info("Scene change. Exposure metered again")
+            self.brightness = brightness
+            self.metered()
+        else:
+            # Exponential moving average of the brightness, in stops.
+            alpha = config.AESmoothing
+            self.brightness = (self.brightness**(1 - alpha) *
+                               brightness**alpha)
+
+        return changed
+
+    # The scene has been metered. The next images give the reference.
+    def metered(self):
+        self.reference = None
+
+    # Exposure time that gives the target luminance for a scene brightness.
+    def exposureFor(self, brightness):
+        metadata = self.cam.metadata
+        exposureTime = (config.AETarget * 2**self.ev /
+                        (brightness * metadata.AnalogueGain *
+                         metadata.DigitalGain))
+
+        return int(min(max(exposureTime, self.cam.minExpTime),
+                       self.cam.maxExpTime))
+
+    # Exposure time of the next frame, from the brightness of the images of
+    # the previous frame. None if there are no previous images.
+    def exposureTime(self):
+        self.update()
+
+        if self.brightness is None:
+            return None
+
+        return self.exposureFor(self.brightness)
+
+    # Without previous images, the frame is metered with some images starting
+    # with the given exposure time. Clipped images are corrected in several
+    # steps.
+    def meter(self, exposureTime):
+        scheduler = self.cam.scheduler
+
+        for i in range(config.AEMaxIterations):
+            scheduler.setExposure(exposureTime)
+            request = scheduler.captureRequest()
+            self.measure(request, self.cam.metadata)
+            request.release()
+
+            self.brightness = self.measurement[1]
+            self.measurement = None
+            self.metered()
+
+            newExposureTime = self.exposureFor(self.brightness)
+            if abs(log2(newExposureTime / exposureTime)) <= config.AETolerance:
+                break
+            exposureTime = newExposureTime
+
+        return newExposureTime
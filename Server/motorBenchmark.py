@@ -0,0 +1,87 @@
+"""
+DSuper8 project based on Joe Herman's rpi-film-capture.
+
+Software modified by Manuel Ángel.
+
+User interface redesigned by Manuel Ángel.
+
+motorBenchmark.py: CPU usage of the motor control process while idle.
+
+The motor control process blocks on its order queue with a timeout, in
+motorOrders(), instead of spinning on motorQueue.empty(). This script runs
+motorOrders() in a separate process for an idle interval, without any order,
+and reports the CPU time used. It also reports the delay from putting an
+order to receiving it.
+It does not need the camera nor the pigpio daemon.
+
+Usage: python3 motorBenchmark.py [idle seconds]
+
+Latest version: 20231130.
+"""
+
+from multiprocessing import Process, Event, Queue
+
+from time import sleep, perf_counter, process_time
+
+from sys import argv, stdout
+
+from logging import INFO, basicConfig, info
+
+from motorOrders import motorOrders
+
+
+# Order loop of the motor control process. The orders are not executed, only
+# the time at which they are received is recorded.
+def orderLoop(motorQueue, exitEvent, results):
+    for msg in motorOrders(motorQueue, exitEvent):
+        results.put(("latency", perf_counter() - msg[1]))
+
+    results.put(("cpu", process_time()))
+
+
+# The loop runs idle for the given time and then receives some orders.
+def measure(idleTime, orders=20):
+    motorQueue = Queue()
+    exitEvent = Event()
+    results = Queue()
+
+    process = Process(target=orderLoop, args=(motorQueue, exitEvent, results))
+    process.start()
+
+    sleep(idleTime)
+
+    for i in range(orders):
+        motorQueue.put(["f", perf_counter()])
+        sleep(0.05)
+
+    exitEvent.set()
+    process.join()
+
+    latencies = []
+    cpuTime = None
+    while cpuTime is None:
+        kind, value = results.get()
+        if kind == "cpu":
+            cpuTime = value
+        else:
+            latencies.append(value)
+
+    elapsedTime = idleTime + orders * 0.05
+
+    return cpuTime, elapsedTime, max(latencies)
+
+
+if __name__ == "__main__":
+
+    # Severity level of the log set to INFO.
+    basicConfig(stream=stdout, level=INFO, format="%(asctime)s - %(levelname)s"
+                " - %(message)s", datefmt="%Y-%m-%d %H:%M:%S")
+
+    idleTime = float(argv[1]) if len(argv) > 1 else 10
+
+    cpuTime, elapsedTime, latency = measure(idleTime)
+    info("Motor order loop: CPU time = " + str(round(cpuTime, 2)) + " s in " +
+         str(round(elapsedTime, 1)) + " s (" +
+         str(round(100 * cpuTime / elapsedTime, 1)) +
+         " %) - Maximum order delay = " + str(round(latency * 1000, 2)) +
+         " ms")
@@ -0,0 +1,31 @@
+"""
+DSuper8 project based on Joe Herman's rpi-film-capture.
+
+Software modified by Manuel Ángel.
+
+User interface redesigned by Manuel Ángel.
+
+motorOrders.py: Reception of the orders of the motor control process.
+
+It does not use pigpio, so it can be run without the pigpio daemon.
+
+Latest version: 20231130.
+"""
+
+from queue import Empty
+
+# Our configuration module.
+import config
+
+
+# Orders received by the motor control process until the exit event is set.
+# The process sleeps on the queue while waiting for them. The exit event is
+# checked at least every config.motorQueueTimeout s.
+def motorOrders(motorQueue, exitEvent):
+    while not exitEvent.is_set():
+        try:
+            msg = motorQueue.get(timeout=config.motorQueueTimeout)
+        except Empty:
+            continue
+
+        yield msg
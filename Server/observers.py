@@ -0,0 +1,201 @@
+"""
+DSuper8 project based on Joe Herman's rpi-film-capture.
+
+Software modified by Manuel Ángel.
+
+User interface redesigned by Manuel Ángel.
+
+observers.py: Read-only observers of the capture.
+
+Latest version: 20231130.
+"""
+
+from socket import (socket, AF_INET, SOCK_STREAM, SOL_SOCKET, SO_REUSEADDR,
+                    timeout)
+
+from threading import Thread, Condition, Lock
+
+from collections import deque
+
+from struct import pack
+
+from time import perf_counter
+
+from logging import info
+
+from picamera2 import MappedArray
+
+from simplejpeg import encode_jpeg_yuv_planes
+
+from numpy import ascontiguousarray
+
+from analysis import yuvPlanes
+
+from protocol import DS8Link
+
+from codes import protocolVersion
+
+# Our configuration module.
+import config
+
+
+# Connection of a read-only observer.
+# The messages are kept in a bounded queue. If the observer does not keep up,
+# the oldest ones are dropped, so that the capture never waits for it.
+class Observer(Thread):
+
+    def __init__(self, sock, address):
+        super(Observer, self).__init__()
+        self.daemon = True
+        self.sock = sock
+        self.address = address
+
+        self.queue = deque(maxlen=config.observerQueue)
+        self.cond = Condition()
+        self.closed = False
+
+        self.start()
+
+    def put(self, message):
+        with self.cond:
+            self.queue.append(message)
+            self.cond.notify()
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify()
+
+    def run(self):
+        try:
+            while True:
+                with self.cond:
+                    self.cond.wait_for(lambda: self.queue or self.closed)
+                    if self.closed:
+                        return
+                    message = self.queue.popleft()
+
+                self.sock.sendall(message)
+
+        except OSError:
+            info("Observer " + self.address[0] + " disconnected")
+
+        finally:
+            self.closed = True
+            self.sock.close()
+
+
+# Fan-out of the frames and of the telemetry to the observers.
+# The messages are framed with protocol 2. The frames are decimated copies of
+# the low resolution stream, sent at most config.observerFps times per second.
+# Each of them is a single message with the same flag as the image sent to the
+# client, and its payload is the image header (exposure time, size) followed
+# by the jpg image.
+# The frames are encoded in a separate thread. If a frame is still waiting when
+# the next one arrives, it is replaced.
+class ObserverHub(Thread):
+
+    def __init__(self, exitEvent):
+        super(ObserverHub, self).__init__()
+        self.daemon = True
+        self.exitEvent = exitEvent
+
+        # Connected observers.
+        self.observers = []
+        self.lock = Lock()
+
+        # The observers always use protocol 2, with their own sequence.
+        self.link = DS8Link()
+        self.link.version.value = protocolVersion
+
+        # Time of the last frame sent to the observers.
+        self.lastFrame = 0
+
+        # Frame waiting to be encoded.
+        self.frames = deque(maxlen=1)
+        self.frameCond = Condition()
+
+        self.socket = socket(AF_INET, SOCK_STREAM)
+        self.socket.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
+        self.socket.bind(('0.0.0.0', config.observerPort))
+        self.socket.listen()
+        self.socket.settimeout(1)
+
+        Thread(target=self.encodeFrames, daemon=True).start()
+
+        self.start()
+
+    # Acceptance of the observer connections. Runs in a separate thread.
+    def run(self):
+        while not self.exitEvent.is_set():
+            try:
+                sock, address = self.socket.accept()
+            except timeout:
+                continue
+            except OSError:
+                return
+
+            with self.lock:
+                self.observers = [observer for observer in self.observers
+                                  if not observer.closed]
+                self.observers.append(Observer(sock, address))
+
+            info("Observer " + address[0] + " connected")
+
+    # A frame is published if there are observers and the previous one was
+    # published long enough ago.
+    def wantFrame(self):
+        if not self.observers:
+            return False
+
+        now = perf_counter()
+        if now - self.lastFrame < 1 / config.observerFps:
+            return False
+
+        self.lastFrame = now
+        return True
+
+    # Publication of a captured frame. Called before the request is released.
+    # Only the decimated planes are copied here; the image is encoded by the
+    # encoding thread.
+    def publishFrame(self, request, flag, exposureTime, frame=0):
+        if not self.wantFrame():
+            return
+
+        step = config.observerDecimation
+        with MappedArray(request, "lores") as m:
+            planes = [ascontiguousarray(plane[::step, ::step]) for plane in
+                      yuvPlanes(m, request.config["lores"]["size"])]
+
+        with self.frameCond:
+            self.frames.append((flag, exposureTime, frame, planes))
+            self.frameCond.notify()
+
+    def encodeFrames(self):
+        while not self.exitEvent.is_set():
+            with self.frameCond:
+                if not self.frameCond.wait_for(lambda: self.frames, 1):
+                    continue
+                flag, exposureTime, frame, planes = self.frames.popleft()
+
+            image = encode_jpeg_yuv_planes(*planes,
+                                           quality=config.observerQuality)
+            self.publish(flag, pack("<iL", exposureTime, len(image)) + image,
+                         frame)
+
+    # Publication of a message with a small payload.
+    def publish(self, flag, payload=b"", frame=0):
+        if not self.observers:
+            return
+
+        message = self.link.message(flag, payload, frame)
+        with self.lock:
+            for observer in self.observers:
+                if not observer.closed:
+                    observer.put(message)
+
+    def close(self):
+        self.socket.close()
+        with self.lock:
+            for observer in self.observers:
+                observer.close()
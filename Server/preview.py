@@ -0,0 +1,100 @@
+"""
+DSuper8 project based on Joe Herman's rpi-film-capture.
+
+Software modified by Manuel Ángel.
+
+User interface redesigned by Manuel Ángel.
+
+preview.py: Adaptation of the preview images to the network link.
+
+Latest version: 20231130.
+"""
+
+from time import perf_counter
+
+from logging import info
+
+# Our configuration module.
+import config
+
+
+# The client requests a new preview image when it has received and displayed
+# the previous one. The time from the capture of a preview image to the
+# request of the next one includes encoding, sending and the client's
+# response. The jpg quality and the decimation of the preview images are
+# adapted so that this time fits in the period of the target frame rate.
+# The configured quality is the upper bound.
+class PreviewGovernor():
+
+    def __init__(self, maxQuality):
+        self.maxQuality = maxQuality
+
+        # Current jpg quality and decimation factor of the preview images.
+        self.quality = maxQuality
+        self.decimation = 1
+
+        # Time when the last preview image was captured.
+        self.captureTime = None
+
+        # Smoothed times in s: from capture to the next request, and sending.
+        self.cycleTime = None
+        self.sendTime = None
+
+        # Images since the last adaptation.
+        self.frames = 0
+
+    # A preview image has been captured.
+    def captured(self):
+        self.captureTime = perf_counter()
+
+    # A preview image has been sent through the connection.
+    def sent(self, seconds):
+        self.sendTime = self.smooth(self.sendTime, seconds)
+
+    # The client requests a new preview image.
+    def requested(self):
+        if self.captureTime is None:
+            return
+
+        self.cycleTime = self.smooth(self.cycleTime,
+                                     perf_counter() - self.captureTime)
+        self.captureTime = None
+
+        self.frames += 1
+        if self.frames >= config.previewAdaptFrames:
+            self.frames = 0
+            self.adapt()
+
+    # The preview is restarted. The times of the previous preview are not
+    # valid.
+    def reset(self):
+        self.captureTime = None
+
+    def smooth(self, old, new):
+        return new if old is None else 0.7 * old + 0.3 * new
+
+    # Quality is lowered before resolution, and resolution is recovered
+    # before quality.
+    def adapt(self):
+        period = 1 / config.previewFps
+        quality, decimation = self.quality, self.decimation
+
+        if self.cycleTime > 1.2 * period:
+            if self.quality > config.previewMinQuality:
+                self.quality = max(self.quality - 10,
+                                   config.previewMinQuality)
+            elif self.decimation < config.previewMaxDecimation:
+                self.decimation *= 2
+
+        elif self.cycleTime < 0.6 * period:
+            if self.decimation > 1:
+                self.decimation //= 2
+            elif self.quality < self.maxQuality:
+                self.quality = min(self.quality + 10, self.maxQuality)
+
+        if (quality, decimation) != (self.quality, self.decimation):
+            info("Preview: quality = " + str(self.quality) +
+                 " - decimation = " + str(self.decimation) +
+                 " - cycle time = " + str(round(self.cycleTime * 1000)) +
+                 " ms - send time = " +
+                 str(round((self.sendTime or 0) * 1000)) + " ms")
@@ -0,0 +1,97 @@
+"""
+DSuper8 project based on Joe Herman's rpi-film-capture.
+
+Software modified by Manuel Ángel.
+
+User interface redesigned by Manuel Ángel.
+
+protocol.py: Framing of the messages sent to the client program.
+
+Latest version: 20231130.
+"""
+
+from struct import pack, unpack, calcsize
+
+from zlib import crc32
+
+from multiprocessing import Value
+
+from codes import msgHeader, msgMagic, msgPayloadCrc, msgMore
+
+
+# Protocol 1: each message is a one byte flag followed by its data.
+# Protocol 2: each message starts with a fixed header, defined in codes.py,
+# with the flag, sequence number, frame number, payload length and checksums.
+# The payload is the same data sent after the flag in protocol 1.
+# The version is negotiated with the client at the beginning of the session.
+# It is shared with the motor control process.
+class DS8Link():
+
+    def __init__(self):
+
+        # Protocol version in use. Protocol 1 until negotiated.
+        self.version = Value("B", 1)
+
+        # Sequence number of the last message sent.
+        self.seq = Value("I", 0)
+
+    # New sequence number.
+    def nextSeq(self):
+        with self.seq.get_lock():
+            self.seq.value += 1
+            return self.seq.value
+
+    # Header of a message.
+    # If crc is None, the payload checksum is not computed.
+    # The chunks of a message share the sequence number. All of them except
+    # the last one are sent with more = True.
+    def header(self, flag, length, frame=0, crc=None, seq=None, more=False):
+
+        if self.version.value < 2:
+            return flag.encode()
+
+        if seq is None:
+            seq = self.nextSeq()
+
+        flags = 0 if crc is None else msgPayloadCrc
+        if more:
+            flags |= msgMore
+
+        header = pack(msgHeader, msgMagic, flag.encode(), flags, seq, frame,
+                      length, crc or 0, 0)[:-calcsize("<I")]
+
+        return header + pack("<I", crc32(header))
+
+    # Complete message with a small payload.
+    def message(self, flag, payload=b"", frame=0):
+        return self.header(flag, len(payload), frame, crc32(payload)) + payload
+
+
+# Reading of a protocol 2 message from a stream.
+# Returns the flag and the payload. The flag is None if the message has to be
+# discarded, and the payload is None if the connection has been closed.
+def readMessage(stream):
+    headerLen = calcsize(msgHeader)
+    header = stream.read(headerLen)
+
+    if len(header) < headerLen:
+        return (None, None)
+
+    # If the header is not valid, the synchronization has been lost.
+    # The next valid header is searched byte by byte.
+    while (header[:len(msgMagic)] != msgMagic or
+           crc32(header[:-4]) != unpack("<I", header[-4:])[0]):
+        byte = stream.read(1)
+        if not byte:
+            return (None, None)
+        header = header[1:] + byte
+
+    (magic, flag, flags, seq, frame, length, payloadCrc,
+     headerCrc) = unpack(msgHeader, header)
+
+    payload = stream.read(length)
+
+    if flags & msgPayloadCrc and crc32(payload) != payloadCrc:
+        return (None, b"")
+
+    return (flag, payload)
@@ -0,0 +1,39 @@
+"""
+DSuper8 project based on Joe Herman's rpi-film-capture.
+
+Software modified by Manuel Ángel.
+
+User interface redesigned by Manuel Ángel.
+
+rawCodec.py: Lossless compression of the raw bayer data.
+
+Latest version: 20231130.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+
+from zlib import compress
+
+# Our configuration module.
+import config
+
+
+# The raw data is split into stripes that are compressed in parallel.
+# zlib releases the GIL while compressing, so the threads use all the cores of
+# the Raspberry Pi.
+class RawCodec():
+
+    def __init__(self):
+
+        # Compression threads.
+        self.pool = ThreadPoolExecutor(max_workers=config.compressThreads)
+
+    # Returns the list of compressed stripes.
+    def compress(self, data, level):
+        view = memoryview(data).cast("B")
+        size = len(view)
+        step = -(-size // config.rawStripes)
+
+        return list(self.pool.map(lambda start:
+                                  compress(view[start:start + step], level),
+                                  range(0, size, step)))
@@ -0,0 +1,83 @@
+"""
+DSuper8 project based on Joe Herman's rpi-film-capture.
+
+Software modified by Manuel Ángel.
+
+User interface redesigned by Manuel Ángel.
+
+settle.py: Detection of the end of the vibrations after a film advance.
+
+Latest version: 20231130.
+"""
+
+from time import monotonic_ns
+
+from logging import info
+
+from analysis import thumbnail, motion
+
+# Our configuration module.
+import config
+
+
+# After the motor stops, the film and the gate can still vibrate.
+# Successive low resolution frames are compared, and the capture is allowed
+# as soon as the motion between two of them falls below a threshold.
+# The settle time is learned for each motor speed, so that the frames that
+# would surely show vibrations are not even compared.
+class SettleDetector():
+
+    def __init__(self, cam):
+        self.cam = cam
+
+        # Learned settle time in s for each motor speed.
+        self.settleTimes = {}
+
+    # Waiting for the film to be still. The motor stop time is that of the
+    # last hold of the exposure scheduler.
+    # speed: peak pulse frequency in Hz of the movement, given by the motor
+    # control process.
+    def wait(self, speed):
+        stopTime = self.cam.scheduler.notBefore
+        deadline = stopTime + int(config.settleTimeout * 1e9)
+        settleTime = self.settleTimes.get(speed)
+
+        # Frames started before a part of the learned settle time are
+        # skipped.
+        flush = stopTime
+        if settleTime is not None:
+            flush += int(config.settleSkip * settleTime * 1e9)
+
+        lastThumb = None
+        lastTime = stopTime
+        while monotonic_ns() < deadline:
+            request = self.cam.captureRequest(flush)
+            flush = None
+            thumb = thumbnail(request, config.settleDecimation)
+            frameTime = self.cam.metadata.SensorTimestamp
+            request.release()
+
+            if (lastThumb is not None and
+                    motion(lastThumb, thumb) < config.settleThreshold):
+                self.learn(speed, (lastTime - stopTime) * 1e-9)
+                break
+
+            lastThumb = thumb
+            lastTime = frameTime
+
+        else:
+            info("Timeout waiting for the film to be still")
+
+        # The image is captured from the next frame.
+        self.cam.scheduler.hold()
+
+    # Exponential moving average of the settle time.
+    def learn(self, speed, seconds):
+        seconds = max(seconds, 0)
+        settleTime = self.settleTimes.get(speed)
+        if settleTime is not None:
+            seconds = 0.8 * settleTime + 0.2 * seconds
+
+        self.settleTimes[speed] = seconds
+        info("Film settle time = " + str(round(seconds * 1000)) + " ms at " +
+             str(speed) + " Hz")
@@ -0,0 +1,17 @@
+"""
+DSuper8 project based on Joe Herman's rpi-film-capture.
+
+Software modified by Manuel Ángel.
+
+User interface redesigned by Manuel Ángel.
+
+conftest.py: The server modules are imported as in the server directory.
+
+Latest version: 20231130.
+"""
+
+from os.path import dirname, abspath
+
+import sys
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
@@ -0,0 +1,87 @@
+"""
+DSuper8 project based on Joe Herman's rpi-film-capture.
+
+Software modified by Manuel Ángel.
+
+User interface redesigned by Manuel Ángel.
+
+test_bracket.py: Flags of the images of a bracketing burst.
+
+The camera and the motor are replaced by stubs, but the server modules
+need picamera2 and a running pigpio daemon, as on the Raspberry Pi.
+
+Latest version: 20231130.
+"""
+
+from concurrent.futures import Future
+
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("picamera2")
+pytest.importorskip("pigpio")
+
+from DS8Server import DS8Server
+
+
+# Server with stubs of the camera, the motor, the encoder and the image
+# streamer. The images queued for sending and the film advances are recorded.
+class StubServer(DS8Server):
+
+    def __init__(self, shots):
+        self.frameNumber = 0
+        self.jpegQualityCap = 97
+        self.queued = []
+        self.advances = 0
+
+        self.cam = SimpleNamespace(
+            stops=2, bracketing=shots, exposureTime=10000,
+            minExpTime=100, maxExpTime=1000000, awb=False,
+            picam2=SimpleNamespace(options={}),
+            scheduler=SimpleNamespace(captureBurst=self.captureBurst))
+
+        self.control = SimpleNamespace(fwdFrame=self.fwdFrame)
+        self.observers = SimpleNamespace(
+            publishFrame=lambda *args: None)
+        self.imgSendThread = SimpleNamespace(getBuffer=lambda: object())
+        self.encoder = SimpleNamespace(submit=self.submit)
+
+    def captureBurst(self, exposures):
+        for shot, exposureTime in enumerate(exposures):
+            yield (shot, object(),
+                   SimpleNamespace(ExposureTime=exposureTime))
+
+    def fwdFrame(self, frames):
+        self.advances += frames
+
+    def submit(self, fn, request, stream):
+        future = Future()
+        future.set_result(None)
+        return future
+
+    def meterImage(self, request, metadata=None):
+        pass
+
+    def queueEncoded(self, future, imgflag, stream, metadata):
+        self.queued.append(imgflag)
+
+
+@pytest.mark.parametrize("shots", range(2, 9))
+def test_last_image_flagged_b(shots):
+    server = StubServer(shots)
+
+    server.takeAndQueueBracket(True)
+
+    assert "".join(server.queued) == "a" * (shots - 1) + "b"
+    assert server.advances == 1
+
+
+@pytest.mark.parametrize("shots", range(2, 9))
+def test_no_advance_without_autoadvance(shots):
+    server = StubServer(shots)
+
+    server.takeAndQueueBracket(False)
+
+    assert "".join(server.queued) == "a" * (shots - 1) + "b"
+    assert server.advances == 0
@@ -0,0 +1,77 @@
+"""
+DSuper8 project based on Joe Herman's rpi-film-capture.
+
+Software modified by Manuel Ángel.
+
+User interface redesigned by Manuel Ángel.
+
+test_settle.py: Detection of the end of the vibrations after a film advance.
+
+The camera is replaced by a stub, but the server modules need picamera2
+to be installed, as on the Raspberry Pi.
+
+Latest version: 20231130.
+"""
+
+from time import monotonic_ns
+
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("picamera2")
+
+import settle
+
+from settle import SettleDetector
+
+
+# Camera whose frames start 10 ms apart after the motor stop. The thumbnail
+# of each frame is its motion: the film is still from the fourth frame.
+class StubCamera():
+
+    def __init__(self):
+        self.stopTime = monotonic_ns()
+        self.frames = 0
+        self.holds = 0
+        self.scheduler = SimpleNamespace(notBefore=self.stopTime,
+                                         hold=self.hold)
+
+    def hold(self):
+        self.holds += 1
+
+    def captureRequest(self, flush=None):
+        self.frames += 1
+        self.metadata = SimpleNamespace(
+            SensorTimestamp=self.stopTime + self.frames * 10000000)
+
+        return SimpleNamespace(thumb=max(4 - self.frames, 0),
+                               release=lambda: None)
+
+
+@pytest.fixture
+def detector(monkeypatch):
+    monkeypatch.setattr(settle, "thumbnail", lambda request, step:
+                        request.thumb)
+    monkeypatch.setattr(settle, "motion", lambda thumb1, thumb2:
+                        abs(thumb1 - thumb2))
+
+    return SettleDetector(StubCamera())
+
+
+def test_wait_learns_new_speed(detector):
+    detector.wait(8500)
+
+    # The fourth and the fifth frames are the first ones without motion.
+    assert detector.settleTimes[8500] == pytest.approx(0.04)
+    assert detector.cam.holds == 1
+
+
+def test_wait_keeps_speeds_apart(detector):
+    detector.wait(8500)
+    detector.cam.stopTime = detector.cam.scheduler.notBefore = monotonic_ns()
+    detector.cam.frames = 0
+    detector.wait(4000)
+
+    assert set(detector.settleTimes) == {4000, 8500}
+    assert detector.settleTimes[4000] == pytest.approx(0.04)